@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Compare the per-metric and the batched dispatch paths of collectd_base.
+
+The metrics are the ones yielded by hypervisor_stats for a synthetic fleet.
+
+Usage: python bench/bench_dispatch.py [--hosts N] [--aggregates N]
+"""
+
+import argparse
+import time
+
+import fake_collectd
+
+fake_collectd.install()
+
+import hypervisor_stats  # noqa
+
+from bench_hypervisor_index import make_fleet  # noqa
+
+
+def as_dicts(metrics):
+    for metric in metrics:
+        if isinstance(metric, tuple):
+            metric = {'plugin_instance': metric[0], 'values': metric[1],
+                      'meta': metric[2]}
+        yield metric
+
+
+def per_metric(plugin, metrics):
+    for metric in as_dicts(metrics):
+        plugin.dispatch_metric(metric)
+
+
+def batched(plugin, metrics):
+    plugin.dispatch_metrics(metrics)
+
+
+def run(func, plugin, hypervisors, repeat):
+    best = None
+    for _ in range(repeat):
+        # Materialize the metrics so that only the dispatch is measured
+        metrics = list(plugin.iter_hypervisor_metrics(hypervisors))
+        fake_collectd.reset()
+        start = time.time()
+        func(plugin, metrics)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, fake_collectd.dispatch_count[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=10000)
+    parser.add_argument('--aggregates', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fake_collectd.capture = False
+    plugin = hypervisor_stats.HypervisorStatsPlugin(fake_collectd, 'bench')
+    plugin.extra_config['cpu_ratio'] = 8.0
+    hypervisors, aggregates = make_fleet(args.hosts, args.aggregates)
+    plugin.update_aggregates(aggregates)
+
+    before, count = run(per_metric, plugin, hypervisors, args.repeat)
+    after, _ = run(batched, plugin, hypervisors, args.repeat)
+    print('{} values dispatched'.format(count))
+    print('per metric: {:8.3f}s'.format(before))
+    print('batched:    {:8.3f}s (x{:.1f})'.format(after, before / after))
+
+
+if __name__ == '__main__':
+    main()
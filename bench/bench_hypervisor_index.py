@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Compare the host-to-aggregate index of hypervisor_stats with the
+nested scan over the aggregates that it replaces, and check that TopK
+reduces the per-host values.
+
+Usage: python bench/bench_hypervisor_index.py [--hosts N] [--aggregates N]
+           [--top-k K]
+"""
+
+import argparse
+import random
+import time
+
+import fake_collectd
+
+fake_collectd.install()
+
+import hypervisor_stats  # noqa
+
+
+def make_fleet(n_hosts, n_aggregates, seed=0):
+    rnd = random.Random(seed)
+    hypervisors = []
+    for i in range(n_hosts):
+        hypervisors.append({
+            'hypervisor_hostname': 'compute-{}.example.com'.format(i),
+            'current_workload': rnd.randint(0, 4),
+            'running_vms': rnd.randint(0, 40),
+            'local_gb_used': rnd.randint(0, 2000),
+            'free_disk_gb': rnd.randint(0, 2000),
+            'memory_mb_used': rnd.randint(0, 512000),
+            'free_ram_mb': rnd.randint(0, 512000),
+            'vcpus_used': rnd.randint(0, 64),
+            'vcpus': 64,
+        })
+    aggregates = []
+    for i in range(n_aggregates):
+        hosts = rnd.sample(range(n_hosts), min(n_hosts, rnd.randint(10, 60)))
+        aggregates.append({
+            'id': i,
+            'name': 'aggregate-{}'.format(i),
+            'hosts': ['compute-{}.example.com'.format(h) for h in hosts],
+        })
+    return hypervisors, aggregates
+
+
+def nested_scan(plugin, hypervisors, aggregates_list):
+    """ The aggregation done by hypervisor_stats before the host index """
+    nova_aggregates = {}
+    for agg in aggregates_list:
+        nova_aggregates[agg['name']] = {
+            'id': agg['id'],
+            'hosts': [h.split('.')[0] for h in agg['hosts']],
+            'metrics': {'free_vcpus': 0},
+        }
+        nova_aggregates[agg['name']]['metrics'].update(
+            {v: 0 for v in plugin.VALUE_MAP.values()})
+
+    count = 0
+    cpu_ratio = plugin.extra_config['cpu_ratio']
+    for stats in hypervisors:
+        host = stats['hypervisor_hostname'].split('.')[0]
+        for k, v in plugin.VALUE_MAP.items():
+            m_val = stats.get(k, 0)
+            count += 1
+            for agg in nova_aggregates.keys():
+                if host in nova_aggregates[agg]['hosts']:
+                    nova_aggregates[agg]['metrics'][v] += m_val
+        free = int(cpu_ratio * stats.get('vcpus', 0)) - stats['vcpus_used']
+        count += 1
+        for agg in nova_aggregates.keys():
+            if host in nova_aggregates[agg]['hosts']:
+                nova_aggregates[agg]['metrics']['free_vcpus'] += free
+    return count + sum(len(a['metrics']) for a in nova_aggregates.values())
+
+
+def indexed(plugin, hypervisors, aggregates_list):
+    plugin.update_aggregates(aggregates_list)
+    return sum(1 for _ in plugin.iter_hypervisor_metrics(hypervisors))
+
+
+def host_values(plugin, hypervisors, aggregates_list):
+    """ Return the names of the per-host values of a cycle, going through
+        update_aggregates() as itermetrics() does """
+    plugin.update_aggregates(aggregates_list)
+    return [metric[0] for metric in plugin.iter_hypervisor_metrics(hypervisors)
+            if isinstance(metric, tuple) and 'host' in (metric[2] or {})]
+
+
+def check_top_k(plugin, hypervisors, aggregates_list, top_k):
+    """ Return the number of per-host values without and with TopK, raise an
+        AssertionError if TopK doesn't bound them """
+    all_hosts = host_values(plugin, hypervisors, aggregates_list)
+    plugin.top_k = top_k
+    try:
+        top_hosts = host_values(plugin, hypervisors, aggregates_list)
+    finally:
+        plugin.top_k = 0
+    limit = 2 * top_k * len(set(all_hosts))
+    assert len(top_hosts) <= limit, \
+        'TopK {}: {} per-host values, expected at most {}'.format(
+            top_k, len(top_hosts), limit)
+    return len(all_hosts), len(top_hosts)
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=10000)
+    parser.add_argument('--aggregates', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top-k', type=int, default=5)
+    args = parser.parse_args()
+
+    plugin = hypervisor_stats.HypervisorStatsPlugin(fake_collectd, 'bench')
+    plugin.extra_config['cpu_ratio'] = 8.0
+    hypervisors, aggregates = make_fleet(args.hosts, args.aggregates)
+
+    before = timeit(lambda: nested_scan(plugin, hypervisors, aggregates),
+                    args.repeat)
+    after = timeit(lambda: indexed(plugin, hypervisors, aggregates),
+                   args.repeat)
+    print('{} hosts, {} aggregates'.format(args.hosts, args.aggregates))
+    print('nested scan: {:8.3f}s'.format(before))
+    print('host index:  {:8.3f}s (x{:.1f})'.format(after, before / after))
+
+    all_hosts, top_hosts = check_top_k(plugin, hypervisors, aggregates,
+                                       args.top_k)
+    print('per-host values: {} ({} with TopK {})'.format(
+        all_hosts, top_hosts, args.top_k))
+
+
+if __name__ == '__main__':
+    main()
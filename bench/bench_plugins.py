@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Run the OpenStack plugins end to end against the fake OpenStack API.
+
+Every plugin runs in its own process so that its peak RSS can be measured.
+The first cycle (which includes the authentication) is reported apart from
+the following ones. The worker state snapshots shared by the plugins are
+expired before every cycle so that each cycle requests the API like the
+first read of a polling interval would.
+
+Usage: python bench/bench_plugins.py [--hosts 100,1000,10000]
+           [--latency SECONDS] [--cycles N] [--plugins a,b]
+           [--regions RegionOne,RegionTwo] [--gzip]
+           [--option Key=Value ...]
+
+Example: python bench/bench_plugins.py --option PaginationLimit=1000 \\
+             --option MaxWorkers=4
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import fake_collectd
+import fake_openstack
+
+PLUGINS = (
+    'check_openstack_api',
+    'hypervisor_stats',
+    'openstack_cinder_services',
+    'openstack_neutron_agents',
+    'openstack_nova_services',
+)
+
+# Options always set for a given plugin module
+PLUGIN_OPTIONS = {
+    'hypervisor_stats': ['CpuAllocationRatio=8.0'],
+}
+
+
+def run_plugin(module_name, auth_url, regions, cycles, options):
+    """ Run a plugin module in the current process and return its figures
+    """
+    os.environ.update({
+        'OS_REGION_NAME': regions,
+        'OS_AUTH_URL': auth_url,
+        'OS_USERNAME': 'admin',
+        'OS_PASSWORD': 'password',
+        'OS_PROJECT_NAME': 'admin',
+        'OS_USER_DOMAIN_NAME': 'default',
+    })
+    fake_collectd.install()
+    fake_collectd.capture = False
+    module = __import__(module_name)
+    openstack = sys.modules['collectd_openstack']
+
+    children = []
+    for option in PLUGIN_OPTIONS.get(module_name, []) + options:
+        key, value = option.split('=', 1)
+        children.append(fake_collectd.Node(key, value.split()))
+    module.config_callback(fake_collectd.Node('Module', [], children))
+
+    durations = []
+    dispatched = []
+    for _ in range(cycles):
+        fake_collectd.reset()
+        # The cycles run back to back, within the same polling interval:
+        # without a fresh store, the services would be served from the
+        # snapshot of the first cycle
+        openstack.worker_states = openstack.WorkerStateStore()
+        start = time.time()
+        module.read_callback()
+        durations.append(time.time() - start)
+        dispatched.append(fake_collectd.dispatch_count[0])
+
+    return {
+        'plugin': module_name,
+        'durations': durations,
+        'dispatched': dispatched,
+        # kilobytes on Linux
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_child(module_name, auth_url, regions, cycles, options):
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', module_name,
+           '--auth-url', auth_url, '--regions', regions,
+           '--cycles', str(cycles)]
+    for option in options:
+        cmd.extend(['--option', option])
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def report(hosts, result, requests):
+    durations = result['durations']
+    warm = sorted(durations[1:]) or durations
+    median = warm[len(warm) // 2]
+    values = result['dispatched'][-1]
+    print('{:>6} {:<26} {:>9.3f} {:>9.3f} {:>9.3f} {:>8} {:>11.0f} '
+          '{:>8} {:>9.1f}'.format(
+              hosts, result['plugin'], durations[0], median, warm[-1],
+              values, values / median if median else 0, requests,
+              result['max_rss_kb'] / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', default='100,1000,10000',
+                        help='comma-separated fleet sizes')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay added to every API response (seconds)')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--plugins', default=','.join(PLUGINS))
+    parser.add_argument('--regions', default='RegionOne',
+                        help='comma-separated regions polled by the plugins')
+    parser.add_argument('--gzip', action='store_true',
+                        help='compress the API responses')
+    parser.add_argument('--option', action='append', default=[],
+                        help='Key=Value option passed to every plugin')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--auth-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_plugin(args.child, args.auth_url, args.regions,
+                            args.cycles, args.option)
+        print(json.dumps(result))
+        return
+
+    print('{:>6} {:<26} {:>9} {:>9} {:>9} {:>8} {:>11} {:>8} {:>9}'.format(
+        'hosts', 'plugin', 'first(s)', 'p50(s)', 'max(s)', 'values',
+        'values/s', 'requests', 'rss(MB)'))
+    for hosts in [int(h) for h in args.hosts.split(',')]:
+        cloud = fake_openstack.FakeOpenStack(
+            hosts, args.latency, regions=args.regions.split(','),
+            gzip=args.gzip).start()
+        try:
+            for plugin in args.plugins.split(','):
+                cloud.requests.clear()
+                result = run_child(plugin, cloud.auth_url, args.regions,
+                                   args.cycles, args.option)
+                report(hosts, result, sum(cloud.requests.values()))
+        finally:
+            cloud.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Stand-in for the 'collectd' module provided by the collectd daemon.
+
+It captures the dispatched values so that the plugins can be run outside
+of collectd. Call install() before importing any plugin module.
+"""
+
+import os
+import sys
+
+PLUGIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'usr', 'lib', 'collectd', 'python-lib')
+
+dispatched = []
+# Set capture to False to only count the dispatched values
+capture = True
+dispatch_count = [0]
+verbose = False
+
+
+class Values(object):
+
+    def __init__(self, **kwargs):
+        self.plugin = ''
+        self.plugin_instance = ''
+        self.host = ''
+        self.type = ''
+        self.type_instance = ''
+        self.values = ()
+        self.meta = {}
+        self.interval = 0
+        self.time = 0
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def dispatch(self, **kwargs):
+        dispatch_count[0] += 1
+        if capture:
+            v = dict(self.__dict__)
+            v.update(kwargs)
+            dispatched.append(v)
+
+
+NOTIF_FAILURE = 1
+NOTIF_WARNING = 2
+NOTIF_OKAY = 4
+
+notifications = []
+
+
+class Notification(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def dispatch(self, **kwargs):
+        n = dict(self.__dict__)
+        n.update(kwargs)
+        notifications.append(n)
+
+
+class Node(object):
+
+    def __init__(self, key, values, children=None):
+        self.key = key
+        self.values = values
+        self.children = children or []
+
+
+def config(**options):
+    """ Build the configuration node passed to a plugin's config_callback
+
+    Example: config(CpuAllocationRatio=8.0, PaginationLimit=100)
+    """
+    return Node('Module', [], [Node(k, [v]) for k, v in options.items()])
+
+
+def _log(level):
+    def log(msg):
+        if verbose or level in ('warning', 'error'):
+            sys.stderr.write('[{}] {}\n'.format(level, msg))
+    return log
+
+
+debug = _log('debug')
+info = _log('info')
+notice = _log('notice')
+warning = _log('warning')
+error = _log('error')
+
+
+def register_config(callback, *args, **kwargs):
+    pass
+
+
+def register_read(callback, *args, **kwargs):
+    pass
+
+
+def register_init(callback, *args, **kwargs):
+    pass
+
+
+def register_shutdown(callback, *args, **kwargs):
+    pass
+
+
+def reset():
+    del dispatched[:]
+    del notifications[:]
+    dispatch_count[0] = 0
+
+
+def install():
+    """ Make 'import collectd' and the plugin modules importable."""
+    sys.modules['collectd'] = sys.modules[__name__]
+    if PLUGIN_PATH not in sys.path:
+        sys.path.insert(0, PLUGIN_PATH)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Local stand-in for the OpenStack APIs polled by the plugins.
+
+It serves Keystone v3 /auth/tokens, the API roots probed by
+check_openstack_api, Nova os-hypervisors/detail (with limit/marker),
+os-aggregates (with ETag) and os-services, Cinder os-services and Neutron
+v2.0/agents for a synthetic fleet of compute hosts.
+
+Usage: python bench/fake_openstack.py [--hosts N] [--latency SECONDS]
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import socket
+import threading
+import time
+import zlib
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+
+PROJECT_ID = 'c0ffee00c0ffee00c0ffee00c0ffee00'
+
+# Every service listens on its own port since check_openstack_api probes the
+# root of the endpoints: name, type, path of the endpoint and status code
+# of the root
+SERVICES = (
+    ('keystone', 'identity', '/v3', 300),
+    ('nova', 'compute', '/v2.1', 200),
+    ('neutron', 'network', '', 200),
+    ('cinder', 'volume', '/v2/' + PROJECT_ID, 200),
+    ('glance', 'image', '', 300),
+    ('heat', 'orchestration', '/v1/' + PROJECT_ID, 300),
+)
+
+
+class Fleet(object):
+    """ The synthetic cloud served by the fake API """
+
+    def __init__(self, hosts, hosts_per_aggregate=20):
+        self.hosts = ['compute-{:05d}.example.com'.format(i)
+                      for i in range(hosts)]
+        self.hypervisors = []
+        for i, host in enumerate(self.hosts):
+            self.hypervisors.append({
+                'id': i + 1,
+                'hypervisor_hostname': host,
+                'hypervisor_type': 'QEMU',
+                'state': 'up',
+                'status': 'enabled',
+                'current_workload': i % 3,
+                'running_vms': i % 40,
+                'vcpus': 64,
+                'vcpus_used': i % 64,
+                'memory_mb': 524288,
+                'memory_mb_used': (i * 4096) % 524288,
+                'free_ram_mb': 524288 - (i * 4096) % 524288,
+                'local_gb': 2000,
+                'local_gb_used': i % 2000,
+                'free_disk_gb': 2000 - i % 2000,
+                'disk_available_least': 2000 - i % 2000,
+                'host_ip': '10.0.{}.{}'.format(i // 250, i % 250 + 1),
+                'service': {'host': host.split('.')[0], 'id': i + 1},
+                'cpu_info': json.dumps({
+                    'arch': 'x86_64', 'model': 'Skylake-Server',
+                    'topology': {'cores': 16, 'sockets': 2, 'threads': 2}}),
+            })
+        self.aggregates = []
+        for i in range(0, hosts, hosts_per_aggregate):
+            self.aggregates.append({
+                'id': len(self.aggregates) + 1,
+                'name': 'aggregate-{}'.format(len(self.aggregates)),
+                'availability_zone': 'nova',
+                'hosts': self.hosts[i:i + hosts_per_aggregate],
+                'metadata': {},
+            })
+        self.aggregates_body = json.dumps({'aggregates': self.aggregates})
+        self.aggregates_etag = '"{}"'.format(
+            hashlib.md5(self.aggregates_body.encode('utf-8')).hexdigest())
+
+    def nova_services(self):
+        return [{'id': i + 1, 'binary': 'nova-compute', 'host': h,
+                 'zone': 'nova', 'status': 'enabled',
+                 'state': 'down' if i % 97 == 0 else 'up',
+                 'updated_at': '2017-10-04T12:00:00.000000'}
+                for i, h in enumerate(self.hosts)]
+
+    def cinder_services(self):
+        services = [{'binary': 'cinder-scheduler',
+                     'host': 'controller-{}'.format(i), 'zone': 'nova',
+                     'status': 'enabled', 'state': 'up',
+                     'updated_at': '2017-10-04T12:00:00.000000'}
+                    for i in range(3)]
+        services.extend({'binary': 'cinder-volume', 'host': h + '@lvm',
+                         'zone': 'nova', 'status': 'enabled',
+                         'state': 'down' if i % 53 == 0 else 'up',
+                         'updated_at': '2017-10-04T12:00:00.000000'}
+                        for i, h in enumerate(self.hosts[::10]))
+        return services
+
+    def neutron_agents(self):
+        agents = [{'id': 'l3-{}'.format(i), 'binary': 'neutron-l3-agent',
+                   'agent_type': 'L3 agent', 'host': 'network-{}'.format(i),
+                   'admin_state_up': True, 'alive': True}
+                  for i in range(3)]
+        agents.extend({'id': 'ovs-{}'.format(i),
+                       'binary': 'neutron-openvswitch-agent',
+                       'agent_type': 'Open vSwitch agent', 'host': h,
+                       'admin_state_up': i % 101 != 0,
+                       'alive': i % 89 != 0}
+                      for i, h in enumerate(self.hosts))
+        return agents
+
+
+class FakeOpenStackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # The headers and the body are written separately, don't let Nagle's
+        # algorithm delay the body of keep-alive responses
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def fleet(self):
+        return self.server.cloud.fleet
+
+    def _send(self, status, body, headers=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        body = body.encode('utf-8')
+        headers = dict(headers or {})
+        if self.server.cloud.gzip and body and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _delay(self):
+        cloud = self.server.cloud
+        cloud.count(self.server.service, self.command,
+                    urlparse(self.path).path)
+        if cloud.latency:
+            time.sleep(cloud.latency)
+
+    def do_POST(self):
+        self._delay()
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if not self.path.endswith('/auth/tokens'):
+            return self._send(404, {'error': 'not found'})
+
+        # All the regions are served by the same endpoints
+        catalog = [{
+            'name': name,
+            'type': service_type,
+            'endpoints': [
+                {'region': region, 'interface': interface,
+                 'url': self.server.cloud.endpoint(name)}
+                for region in self.server.cloud.regions
+                for interface in ('public', 'internal', 'admin')],
+        } for name, service_type, _, _ in SERVICES]
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self._send(201, {'token': {
+            'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%S.000000Z'),
+            'project': {'id': PROJECT_ID, 'name': 'admin'},
+            'catalog': catalog,
+        }}, {'X-Subject-Token': 'fake-token'})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self._delay()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.rstrip('/')
+        service = self.server.service
+
+        if path == '':
+            return self._send(self.server.status, {'versions': []})
+        elif service == 'nova' and path.endswith('/os-hypervisors/detail'):
+            hypervisors = self.fleet.hypervisors
+            start = 0
+            if 'marker' in query:
+                # the ids of the hypervisors start at 1
+                start = int(query['marker'][0])
+            end = len(hypervisors)
+            if 'limit' in query:
+                end = min(end, start + int(query['limit'][0]))
+            return self._send(200, {'hypervisors': hypervisors[start:end]})
+        elif service == 'nova' and path.endswith('/os-aggregates'):
+            etag = self.fleet.aggregates_etag
+            if self.headers.get('If-None-Match') == etag:
+                return self._send(304, '', {'ETag': etag})
+            return self._send(200, self.fleet.aggregates_body,
+                              {'ETag': etag})
+        elif service == 'nova' and path.endswith('/os-services'):
+            return self._send(200, {'services': self.fleet.nova_services()})
+        elif service == 'cinder' and path.endswith('/os-services'):
+            return self._send(200,
+                              {'services': self.fleet.cinder_services()})
+        elif service == 'neutron' and path.endswith('/v2.0/agents'):
+            return self._send(200, {'agents': self.fleet.neutron_agents()})
+        self._send(404, {'error': 'not found'})
+
+
+class ServiceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cloud, service, status, address):
+        HTTPServer.__init__(self, address, FakeOpenStackHandler)
+        self.cloud = cloud
+        self.service = service
+        self.status = status
+
+
+class FakeOpenStack(object):
+    """ One HTTP server per service, all sharing the same fleet """
+
+    def __init__(self, hosts, latency=0, host='127.0.0.1', port=0,
+                 regions=('RegionOne',), gzip=False):
+        self.fleet = Fleet(hosts)
+        self.latency = latency
+        self.gzip = gzip
+        self.regions = regions
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._servers = {}
+        self._paths = {}
+        for i, (name, _, path, status) in enumerate(SERVICES):
+            self._servers[name] = ServiceServer(
+                self, name, status, (host, port + i if port else 0))
+            self._paths[name] = path
+
+    def endpoint(self, service):
+        host, port = self._servers[service].server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, self._paths[service])
+
+    @property
+    def auth_url(self):
+        return self.endpoint('keystone')
+
+    def count(self, service, verb, path):
+        with self._lock:
+            key = '{} {} {}'.format(service, verb, path)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def start(self):
+        for server in self._servers.values():
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+        return self
+
+    def stop(self):
+        for server in self._servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--port', type=int, default=5000,
+                        help='first of the ports used by the services')
+    parser.add_argument('--regions', default='RegionOne',
+                        help='comma-separated regions of the catalog')
+    parser.add_argument('--gzip', action='store_true',
+                        help='compress the responses when accepted')
+    args = parser.parse_args()
+
+    cloud = FakeOpenStack(args.hosts, args.latency, port=args.port,
+                          regions=args.regions.split(','),
+                          gzip=args.gzip).start()
+    print('OS_AUTH_URL={}'.format(cloud.auth_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cloud.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -28,10 +28,17 @@ ReadThreads 10
     KeystoneUrl "{{ OS_AUTH_URL }}"
     Password "{{ OS_PASSWORD }}"
     PollingInterval {{ OS_POLLING_INTERVAL | default(30) }}
+    Stagger {{ OS_STAGGER | default('false') }}
+    Jitter {{ OS_JITTER | default(0) }}
+    AsyncCollection {{ OS_ASYNC_COLLECTION | default('false') }}
+    OutOfProcess {{ OS_OUT_OF_PROCESS | default('false') }}
+    SnapshotDir "{{ OS_SNAPSHOT_DIR | default('') }}"
     Tenant "{{ OS_PROJECT_NAME }}"
     UserDomain "{{ OS_USER_DOMAIN_NAME }}"
     Timeout {{ OS_TIMEOUT | default(10) }}
     Username "{{ OS_USERNAME }}"
+    MaxWorkers {{ OS_API_CHECK_WORKERS | default(1) }}
+    ProbeStrategy "{{ OS_API_PROBE_STRATEGY | default('get') }}"
   </Module>
   Import "openstack_cinder_services"
 
@@ -39,18 +46,45 @@ ReadThreads 10
     KeystoneUrl "{{ OS_AUTH_URL }}"
     Password "{{ OS_PASSWORD }}"
     PollingInterval {{ OS_POLLING_INTERVAL | default(30) }}
+    Stagger {{ OS_STAGGER | default('false') }}
+    Jitter {{ OS_JITTER | default(0) }}
+    AsyncCollection {{ OS_ASYNC_COLLECTION | default('false') }}
+    OutOfProcess {{ OS_OUT_OF_PROCESS | default('false') }}
+    SnapshotDir "{{ OS_SNAPSHOT_DIR | default('') }}"
     Tenant "{{ OS_PROJECT_NAME }}"
     UserDomain "{{ OS_USER_DOMAIN_NAME }}"    
     Timeout {{ OS_TIMEOUT | default(10) }}
     Username "{{ OS_USERNAME }}"
   </Module>
 
+  Import "openstack_nova_services"
+
+  <Module "openstack_nova_services">
+    KeystoneUrl "{{ OS_AUTH_URL }}"
+    Password "{{ OS_PASSWORD }}"
+    PollingInterval {{ OS_POLLING_INTERVAL | default(30) }}
+    Stagger {{ OS_STAGGER | default('false') }}
+    Jitter {{ OS_JITTER | default(0) }}
+    AsyncCollection {{ OS_ASYNC_COLLECTION | default('false') }}
+    OutOfProcess {{ OS_OUT_OF_PROCESS | default('false') }}
+    SnapshotDir "{{ OS_SNAPSHOT_DIR | default('') }}"
+    Tenant "{{ OS_PROJECT_NAME }}"
+    UserDomain "{{ OS_USER_DOMAIN_NAME }}"
+    Timeout {{ OS_TIMEOUT | default(10) }}
+    Username "{{ OS_USERNAME }}"
+  </Module>
+
   Import "openstack_neutron_agents"
 
   <Module "openstack_neutron_agents">
     KeystoneUrl "{{ OS_AUTH_URL }}"
     Password "{{ OS_PASSWORD }}"
     PollingInterval {{ OS_POLLING_INTERVAL | default(30) }}
+    Stagger {{ OS_STAGGER | default('false') }}
+    Jitter {{ OS_JITTER | default(0) }}
+    AsyncCollection {{ OS_ASYNC_COLLECTION | default('false') }}
+    OutOfProcess {{ OS_OUT_OF_PROCESS | default('false') }}
+    SnapshotDir "{{ OS_SNAPSHOT_DIR | default('') }}"
     Tenant "{{ OS_PROJECT_NAME }}"
     Timeout {{ OS_TIMEOUT | default(10) }}
     Username "{{ OS_USERNAME }}"
@@ -62,11 +96,21 @@ ReadThreads 10
     CpuAllocationRatio "8.0"
     KeystoneUrl "{{ OS_AUTH_URL }}"
     Password "{{ OS_PASSWORD }}"
-    PollingInterval {{ OS_POLLING_INTERVAL | default(30) }}
+    PollingInterval {{ OS_HYPERVISOR_POLLING_INTERVAL | default(180) }}
+    Stagger {{ OS_STAGGER | default('false') }}
+    Jitter {{ OS_JITTER | default(0) }}
+    AsyncCollection {{ OS_ASYNC_COLLECTION | default('false') }}
+    OutOfProcess {{ OS_OUT_OF_PROCESS | default('false') }}
+    SnapshotDir "{{ OS_SNAPSHOT_DIR | default('') }}"
     Tenant "{{ OS_PROJECT_NAME }}"
     UserDomain "{{ OS_USER_DOMAIN_NAME }}"    
     Timeout {{ OS_TIMEOUT | default(10) }}
     Username "{{ OS_USERNAME }}"
+    PaginationLimit {{ OS_PAGINATION_LIMIT | default(0) }}
+    CacheTTL "os-aggregates" {{ OS_AGGREGATES_CACHE_TTL | default(300) }}
+    TopK {{ OS_HYPERVISOR_TOP_K | default(0) }}
+    BatchDispatch true
+    AdaptiveInterval true
   </Module>
   
 </Plugin>
@@ -14,8 +14,13 @@
 
 import collectd
 
+import collectd_base as base
 import collectd_openstack as openstack
 
+import requests
+import socket
+import ssl
+import time
 from urlparse import urlparse
 
 PLUGIN_NAME = 'check_openstack_api'
@@ -23,7 +28,17 @@ INTERVAL = openstack.INTERVAL
 
 
 class APICheckPlugin(openstack.CollectdPlugin):
-    """Class to check the status of OpenStack API services."""
+    """Class to check the status of OpenStack API services.
+
+    The 'probe' of a check (ProbeStrategy by default) is one of:
+        - 'get', a GET of the URL
+        - 'head', a HEAD of the URL
+        - 'stream', a GET closing the connection after the status line
+        - 'connect', a TCP connection (and TLS handshake for https) to the
+          endpoint without request, the expected status codes are ignored
+    """
+
+    PROBE_STRATEGIES = ('get', 'head', 'stream', 'connect')
 
     CHECK_MAP = {
         'keystone': {
@@ -54,6 +69,40 @@ class APICheckPlugin(openstack.CollectdPlugin):
         super(APICheckPlugin, self).__init__(*args, **kwargs)
         self.plugin = PLUGIN_NAME
         self.interval = INTERVAL
+        self.max_workers = 1
+        self.check_deadline = None
+        self._pool = None
+        # Probes of the catalog and catalog version they come from, see
+        # check_plan()
+        self._plan = []
+        self._plan_version = None
+        # Probe strategy of the checks without one, and by service name
+        self.probe_strategy = 'get'
+        self.probe_strategies = {}
+        self._ssl_context = None
+
+    def config_callback(self, config):
+        super(APICheckPlugin, self).config_callback(config)
+        for node in config.children:
+            if node.key == 'MaxWorkers':
+                self.max_workers = int(node.values[0])
+            elif node.key == 'CheckDeadline':
+                self.check_deadline = int(node.values[0])
+            elif node.key == 'ProbeStrategy':
+                strategy = node.values[-1]
+                if strategy not in self.PROBE_STRATEGIES:
+                    self.logger.warning(
+                        "Unknown probe strategy '%s', expected one of %s" % (
+                            strategy, ', '.join(self.PROBE_STRATEGIES)))
+                elif len(node.values) > 1:
+                    self.probe_strategies[node.values[0]] = strategy
+                else:
+                    self.probe_strategy = strategy
+
+        if self.max_workers > 1:
+            self._pool = base.WorkerPool(self.max_workers, name=PLUGIN_NAME)
+            if self.check_deadline is None:
+                self.check_deadline = self.polling_interval
 
     def _service_url(self, endpoint, path):
         url = urlparse(endpoint)
@@ -62,52 +111,201 @@ class APICheckPlugin(openstack.CollectdPlugin):
             u = '%s/%s' % (u, path)
         return u
 
-    def check_api(self):
-        """ Check the status of all the API services.
+    def check_plan(self):
+        """ Return the probes of the services of the catalog
 
-            Yields a list of dict items with 'service', 'status' (either OK,
-            FAIL or UNKNOWN) and 'region' keys.
+            The probes are compiled once per catalog: each one is a dict
+            with the 'name' of the check, the 'url' to get, the 'expect'ed
+            status codes, whether the token is required ('auth') and the
+            'meta' of its metrics. The services without check are logged
+            once per catalog and left out.
         """
         catalog = self.service_catalog
+        version = self.os_client.catalog_version
+        if version == self._plan_version:
+            return self._plan
+
+        plan = []
         for service in catalog:
             name = service['name']
-            if name not in self.CHECK_MAP:
+            check = self.CHECK_MAP.get(name)
+            if check is None:
                 self.logger.notice(
                     "No check found for service '%s', skipping it" % name)
-                status = self.UNKNOWN
-                check = {}
+                continue
+            plan.append({
+                'service': name,
+                'name': check['name'],
+                'strategy': self.probe_strategies.get(
+                    name, check.get('probe', self.probe_strategy)),
+                'url': self._service_url(service['url'], check['path']),
+                'expect': frozenset(check['expect']),
+                'auth': check.get('auth', False),
+                'meta': {'region': service['region']},
+            })
+        self._plan = plan
+        self._plan_version = version
+        return plan
+
+    def check_service(self, probe):
+        """ Run one probe of check_plan().
+
+            Returns the status (either OK or FAIL) and the (phase, seconds)
+            timings of the probe: 'dns', 'connect', 'tls' and 'first_byte'
+            for the stream and connect strategies (up to the failing
+            phase), 'first_byte' for the get and head ones.
+        """
+        strategy = probe['strategy']
+        if strategy in ('stream', 'connect'):
+            phases = []
+            try:
+                status_code = self.socket_probe(probe, phases,
+                                                strategy == 'stream')
+            except (socket.error, ssl.SSLError, ValueError, IndexError) as e:
+                self.logger.notice("Service %s check failed (%s probe): %s" % (
+                    probe['service'], strategy, e))
+                return self.FAIL, phases
+            if status_code is None:
+                return self.OK, phases
+        else:
+            if strategy == 'head':
+                r = self.raw_head(probe['url'], token_required=probe['auth'],
+                                  service=probe['service'])
             else:
-                check = self.CHECK_MAP[name]
-                url = self._service_url(service['url'], check['path'])
-                r = self.raw_get(url, token_required=check.get('auth', False))
+                r = self.raw_get(probe['url'], token_required=probe['auth'],
+                                 service=probe['service'])
+            status_code = None if r is None else r.status_code
+            phases = []
+            if r is not None:
+                # Until the headers are parsed, the body isn't included
+                phases.append(('first_byte', r.elapsed.total_seconds()))
+
+        if status_code not in probe['expect']:
+            self.logger.notice(
+                "Service %s check failed "
+                "(returned '%s' but expected '%s')" % (
+                    probe['service'],
+                    'N/A' if status_code is None else status_code,
+                    sorted(probe['expect']))
+            )
+            return self.FAIL, phases
+        return self.OK, phases
+
+    def socket_probe(self, probe, phases, request):
+        """ Connect to the endpoint of a probe, timing each phase in phases
+
+            With request, a GET is sent and the connection is closed once
+            the status line is received. Returns its status code, None
+            without request. Raises socket.error, ssl.SSLError, ValueError
+            or IndexError on failure.
+        """
+        url = urlparse(probe['url'])
+        https = url.scheme == 'https'
+        port = url.port or (443 if https else 80)
 
-                if r is None or r.status_code not in check['expect']:
-                    def _status(ret):
-                        return 'N/A' if r is None else r.status_code
+        started_at = time.time()
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            url.hostname, port, 0, socket.SOCK_STREAM)[0]
+        now = time.time()
+        phases.append(('dns', now - started_at))
+        started_at = now
 
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+            now = time.time()
+            phases.append(('connect', now - started_at))
+            started_at = now
+            if https:
+                if self._ssl_context is None:
+                    self._ssl_context = ssl.create_default_context(
+                        cafile=requests.certs.where())
+                sock = self._ssl_context.wrap_socket(
+                    sock, server_hostname=url.hostname)
+                now = time.time()
+                phases.append(('tls', now - started_at))
+                started_at = now
+            if not request:
+                return None
+
+            path = url.path or '/'
+            if url.query:
+                path = '%s?%s' % (path, url.query)
+            lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % url.netloc,
+                     'Connection: close']
+            if probe['auth']:
+                lines.append(
+                    'X-Auth-Token: %s' % self.os_client.ensure_token())
+            sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8'))
+            data = sock.recv(1024)
+            phases.append(('first_byte', time.time() - started_at))
+            while data and b'\n' not in data and len(data) < 1024:
+                chunk = sock.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+            # e.g. HTTP/1.1 300 Multiple Choices
+            return int(data.split(None, 2)[1])
+        finally:
+            sock.close()
+
+    def check_api(self):
+        """ Check the status of all the API services.
+
+            Yields (probe, status, duration, phases) tuples, where status is
+            either OK or FAIL and phases the timings of check_service().
+            When MaxWorkers is greater than 1, the services are checked
+            concurrently and the services which haven't answered before
+            CheckDeadline are reported as failed. The probes are always
+            yielded in catalog order.
+        """
+        plan = self.check_plan()
+        if self._pool is None:
+            for probe in plan:
+                started_at = time.time()
+                status, phases = self.check_service(probe)
+                yield probe, status, time.time() - started_at, phases
+            return
+
+        jobs = self._pool.map(self.check_service, plan,
+                              timeout=self.check_deadline)
+        for probe, job in zip(plan, jobs):
+            if job.done and job.exception is None and not job.cancelled:
+                status, phases = job.result
+            else:
+                if job.exception is not None:
                     self.logger.notice(
-                        "Service %s check failed "
-                        "(returned '%s' but expected '%s')" % (
-                            name, _status(r), check['expect'])
-                    )
-                    status = self.FAIL
+                        "Service %s check failed: %s" % (
+                            probe['service'], job.exception))
                 else:
-                    status = self.OK
+                    self.logger.notice(
+                        "Service %s check didn't complete within %ds" % (
+                            probe['service'], self.check_deadline))
+                status, phases = self.FAIL, []
+            yield probe, status, job.duration, phases
 
+    def itermetrics(self):
+        for probe, status, duration, phases in self.check_api():
             yield {
-                'service': check.get('name', name),
-                'status': status,
-                'region': service['region']
+                'plugin_instance': probe['name'],
+                'values': status,
+                'meta': probe['meta'],
             }
-
-    def itermetrics(self):
-        for item in self.check_api():
-            if item['status'] != self.UNKNOWN:
-                # skip if status is UNKNOWN
+            if duration is not None:
+                yield {
+                    'plugin_instance': probe['name'],
+                    'type': 'response_time',
+                    'values': duration,
+                    'meta': probe['meta'],
+                }
+            for phase, seconds in phases:
                 yield {
-                    'plugin_instance': item['service'],
-                    'values': item['status'],
-                    'meta': {'region': item['region']},
+                    'plugin_instance': probe['name'],
+                    'type': 'response_time',
+                    'type_instance': phase,
+                    'values': seconds,
+                    'meta': probe['meta'],
                 }
 
 
@@ -13,21 +13,503 @@
 # limitations under the License.
 
 from functools import wraps
+import errno
 import json
+import mmap
+import random
+import select
 import signal
+import socket
+import struct
 import subprocess
 import threading
 import time
 import traceback
 import os
+import zlib
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 INTERVAL = 10
 
+# Frames exchanged with the worker process of a plugin (see ProcessWorker):
+# a header holding the kind and the length of the payload
+FRAME_HEADER = struct.Struct('!BI')
+(FRAME_CONFIG, FRAME_COLLECT, FRAME_METRICS, FRAME_LOG, FRAME_NOTIFICATION,
+ FRAME_DONE) = range(1, 7)
+# A metric of a METRICS frame: indexes of its plugin instance, type, type
+# instance, hostname and meta (JSON, 0 without meta) in the string table of
+# the frame, its interval (0 without interval of its own) and number of
+# values, followed by the values as doubles
+METRIC_RECORD = struct.Struct('!IIIIIIB')
+
+# Snapshot file of a plugin (see Base.save_snapshot()): magic, version,
+# time of the snapshot and sizes of the state (JSON) and of the values (a
+# METRICS payload) which follow
+SNAPSHOT_HEADER = struct.Struct('!4sBdII')
+SNAPSHOT_MAGIC = b'CDSN'
+SNAPSHOT_VERSION = 1
+
 
 class CheckException(Exception):
     pass
 
 
+def write_frame(fd, kind, payload):
+    data = FRAME_HEADER.pack(kind, len(payload)) + payload
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def read_frame(fd, deadline=None):
+    """Read a frame from a file descriptor and return its kind and payload
+
+    A CheckException is raised when the other end closes the pipe or when
+    the deadline (a time.time() value) is reached.
+    """
+    kind, length = FRAME_HEADER.unpack(_read(fd, FRAME_HEADER.size, deadline))
+    return kind, _read(fd, length, deadline)
+
+
+def _read(fd, size, deadline):
+    chunks = []
+    while size:
+        if deadline is not None and not select.select(
+                [fd], [], [], max(0, deadline - time.time()))[0]:
+            raise CheckException('Timed out reading from the worker process')
+        chunk = os.read(fd, min(size, 1 << 20))
+        if not chunk:
+            raise CheckException('The worker process closed its pipe')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def pack_metrics(metrics):
+    """Encode metric dicts or tuples as the payload of a METRICS frame"""
+    strings = ['']
+    index = {'': 0}
+    # JSON of the meta dicts by id, the dicts are kept to keep their id
+    metas = {}
+
+    def string_id(string):
+        i = index.get(string)
+        if i is None:
+            i = index[string] = len(strings)
+            strings.append(string)
+        return i
+
+    records = []
+    for metric in metrics:
+        if isinstance(metric, tuple):
+            metric_type = 'gauge'
+            type_instance = ''
+            hostname = ''
+            plugin_instance = metric[0]
+            values = metric[1]
+            meta = metric[2] if len(metric) > 2 else None
+            interval = 0
+        else:
+            metric_type = metric.get('type', 'gauge')
+            type_instance = str(metric.get('type_instance', ''))
+            hostname = metric.get('hostname', '')
+            plugin_instance = metric.get('plugin_instance', '')
+            values = metric['values']
+            meta = metric.get('meta')
+            interval = metric.get('interval', 0)
+        if type(values) not in (list, tuple):
+            values = (values,)
+
+        meta_id = 0
+        if meta:
+            cached = metas.get(id(meta))
+            if cached is None:
+                cached = metas[id(meta)] = (
+                    meta, string_id(json.dumps(meta, sort_keys=True)))
+            meta_id = cached[1]
+        records.append(METRIC_RECORD.pack(
+            string_id(plugin_instance), string_id(metric_type),
+            string_id(type_instance), string_id(hostname), meta_id,
+            int(interval), len(values)))
+        records.append(struct.pack('!{}d'.format(len(values)), *values))
+
+    table = json.dumps(strings).encode('utf-8')
+    return struct.pack('!I', len(table)) + table + b''.join(records)
+
+
+def unpack_metrics(payload):
+    """Iterate over the metrics of a METRICS frame
+
+    The gauges with a single value and without type instance, hostname
+    nor interval are returned as compact tuples, the other metrics as dicts.
+    """
+    size = struct.unpack_from('!I', payload)[0]
+    strings = json.loads(payload[4:4 + size].decode('utf-8'))
+    metas = {}
+    offset = 4 + size
+    while offset < len(payload):
+        (plugin_instance, metric_type, type_instance, hostname, meta_id,
+         interval, count) = METRIC_RECORD.unpack_from(payload, offset)
+        offset += METRIC_RECORD.size
+        values = struct.unpack_from('!{}d'.format(count), payload, offset)
+        offset += 8 * count
+
+        meta = None
+        if meta_id:
+            meta = metas.get(meta_id)
+            if meta is None:
+                meta = metas[meta_id] = json.loads(strings[meta_id])
+        if strings[metric_type] == 'gauge' and not type_instance and \
+                not hostname and not interval and count == 1:
+            yield (strings[plugin_instance], values[0], meta)
+            continue
+        metric = {
+            'plugin_instance': strings[plugin_instance],
+            'type': strings[metric_type],
+            'type_instance': strings[type_instance],
+            'hostname': strings[hostname],
+            'values': list(values),
+        }
+        if meta is not None:
+            metric['meta'] = meta
+        if interval:
+            metric['interval'] = interval
+        yield metric
+
+
+def config_to_dict(node):
+    """Return a collectd configuration node as nested dicts"""
+    return {
+        'key': node.key,
+        'values': list(node.values),
+        'children': [config_to_dict(child) for child in node.children],
+    }
+
+
+class ProcessWorker(object):
+    """A Python process running the read cycles of a plugin
+
+    The process (see collectd_worker.py) receives the configuration of the
+    plugin once, then runs a cycle for each COLLECT frame and sends back the
+    values in METRICS frames, the log messages and the notifications as
+    they come and the plugin's counters at the end of the cycle. It is
+    restarted on the next cycle if it dies or doesn't answer in time.
+    """
+
+    SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'collectd_worker.py')
+
+    def __init__(self, python, module, config, logger):
+        self.python = python
+        self.module = module
+        self.config = config
+        self.logger = logger
+        self._process = None
+
+    def start(self):
+        self._process = subprocess.Popen([self.python, self.SCRIPT],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         close_fds=True)
+        write_frame(self._process.stdin.fileno(), FRAME_CONFIG,
+                    json.dumps({'module': self.module,
+                                'config': self.config}).encode('utf-8'))
+
+    def stop(self):
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def collect(self, plugin, timeout):
+        """Run a cycle in the worker process and yield its values"""
+        if self._process is None or self._process.poll() is not None:
+            self.stop()
+            self.start()
+        done = False
+        try:
+            write_frame(self._process.stdin.fileno(), FRAME_COLLECT, b'')
+            fd = self._process.stdout.fileno()
+            deadline = time.time() + timeout
+            while True:
+                kind, payload = read_frame(fd, deadline)
+                if kind == FRAME_METRICS:
+                    for metric in unpack_metrics(payload):
+                        yield metric
+                elif kind == FRAME_LOG:
+                    level, message = json.loads(payload.decode('utf-8'))
+                    getattr(self.logger, level)(message)
+                elif kind == FRAME_NOTIFICATION:
+                    plugin.dispatch_notification(
+                        *json.loads(payload.decode('utf-8')))
+                elif kind == FRAME_DONE:
+                    done = True
+                    result = json.loads(payload.decode('utf-8'))
+                    plugin.stats.load(result['stats'])
+                    if result['check']:
+                        raise CheckException(result['error'])
+                    elif result['error']:
+                        raise Exception(result['error'])
+                    return
+        except (OSError, IOError) as e:
+            raise CheckException('Lost the worker process: {}'.format(e))
+        finally:
+            if not done:
+                # The frames left in the pipe would be read by the next cycle
+                self.stop()
+
+
+class Job(object):
+    """A function call submitted to a WorkerPool."""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = False
+        self._event = threading.Event()
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    @property
+    def duration(self):
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    def run(self):
+        if self.cancelled:
+            self._event.set()
+            return
+        self.started_at = time.time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.exception = e
+        finally:
+            self.finished_at = time.time()
+            self._event.set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self.done
+
+    def cancel(self):
+        """Prevent the job from running if it hasn't started yet."""
+        self.cancelled = True
+
+
+class WorkerPool(object):
+    """A bounded pool of daemon threads executing jobs.
+
+    The threads are started on the first submission and live as long as the
+    collectd process. A job which overruns a deadline keeps its thread busy
+    until it returns so blocking calls must have their own timeout.
+    """
+
+    def __init__(self, size, name='worker'):
+        self.size = max(1, size)
+        self.name = name
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                t = threading.Thread(
+                    target=self._run,
+                    name='{}-{}'.format(self.name, len(self._threads)))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.run()
+
+    def submit(self, func, *args, **kwargs):
+        return self.put(Job(func, args, kwargs))
+
+    def put(self, job):
+        """Queue a Job created by the caller."""
+        self._start()
+        self._queue.put(job)
+        return job
+
+    def map(self, func, items, timeout=None):
+        """Call func on every item and wait for all the calls to return.
+
+        The list of jobs is returned in the same order as the items. When
+        timeout (in seconds) is reached, the pending jobs are cancelled and
+        the jobs still running are left behind: their 'done' attribute is
+        False.
+        """
+        jobs = [self.submit(func, item) for item in items]
+        deadline = None if timeout is None else time.time() + timeout
+        for job in jobs:
+            if deadline is None:
+                job.wait()
+            elif not job.wait(max(0, deadline - time.time())):
+                job.cancel()
+        return jobs
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(size):
+    """Return the WorkerPool running the cycles of the plugins with
+    AsyncCollection, shared by the whole process.
+
+    The pool grows to the largest size requested.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = WorkerPool(size, name='engine')
+        else:
+            _engine.size = max(_engine.size, size)
+        return _engine
+
+
+class Instrumentation(object):
+    """Thread-safe counters and histograms about the plugin itself.
+
+    All the values are cumulative since the start of collectd so they are
+    dispatched as DERIVE values. A histogram counts the observations lower
+    than or equal to each of the BUCKETS upper bounds (in seconds).
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name, key='', value=1):
+        with self._lock:
+            self._counters[(name, key)] = \
+                self._counters.get((name, key), 0) + value
+
+    def value(self, name, key=''):
+        with self._lock:
+            return self._counters.get((name, key), 0)
+
+    def observe(self, name, key, value):
+        with self._lock:
+            buckets = self._histograms.get((name, key))
+            if buckets is None:
+                buckets = [0] * len(self.BUCKETS)
+                self._histograms[(name, key)] = buckets
+            for i, le in enumerate(self.BUCKETS):
+                if value <= le:
+                    buckets[i] += 1
+
+    def snapshot(self):
+        """Return the counters and the histograms as JSON-friendly lists"""
+        with self._lock:
+            return {
+                'counters': [[name, key, value] for (name, key), value
+                             in self._counters.items()],
+                'histograms': [[name, key, list(buckets)] for (name, key),
+                               buckets in self._histograms.items()],
+            }
+
+    def load(self, snapshot):
+        """Set the counters and the histograms of a snapshot()"""
+        with self._lock:
+            for name, key, value in snapshot['counters']:
+                self._counters[(name, key)] = value
+            for name, key, buckets in snapshot['histograms']:
+                self._histograms[(name, key)] = buckets
+
+    def itermetrics(self):
+        """Yield the counters and histograms as metric dicts."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (k, list(v)) for k, v in self._histograms.items())
+
+        for (name, key), value in counters:
+            yield {
+                'plugin_instance': 'collector_{}'.format(name),
+                'type': 'derive',
+                'type_instance': key,
+                'values': int(value),
+            }
+        for (name, key), buckets in histograms:
+            for le, count in zip(self.BUCKETS, buckets):
+                yield {
+                    'plugin_instance': 'collector_{}_bucket'.format(name),
+                    'type': 'derive',
+                    'type_instance': '{}.le_{}'.format(key, le),
+                    'values': count,
+                }
+
+
+class StateTracker(object):
+    """Remember the last reported state of a set of items.
+
+    It is used to only report the items whose state has changed since the
+    previous cycle, the unchanged items being reported again once every
+    'heartbeat' seconds.
+    """
+
+    def __init__(self, heartbeat):
+        self.heartbeat = heartbeat
+        # key -> [state, changed_at, reported_at, generation]
+        self._states = {}
+        self._generation = 0
+
+    def start(self):
+        """Start a new collection cycle."""
+        self._generation += 1
+
+    def update(self, key, state, now=None):
+        """Record the current state of an item
+
+        Returns a (report, transition) tuple where report tells whether the
+        state should be reported and transition is None or a
+        (previous_state, seconds_in_previous_state) tuple.
+        """
+        now = now or time.time()
+        entry = self._states.get(key)
+        if entry is None:
+            self._states[key] = [state, now, now, self._generation]
+            return True, None
+
+        entry[3] = self._generation
+        if entry[0] != state:
+            transition = (entry[0], now - entry[1])
+            entry[0] = state
+            entry[1] = entry[2] = now
+            return True, transition
+        if now - entry[2] >= self.heartbeat:
+            entry[2] = now
+            return True, None
+        return False, None
+
+    def prune(self):
+        """Forget the items which weren't updated during the cycle."""
+        for key in [k for k, v in self._states.items()
+                    if v[3] != self._generation]:
+            del self._states[key]
+
+
 class Base(object):
     """Base class for writing Python plugins."""
 
@@ -37,6 +519,21 @@ class Base(object):
 
     MAX_IDENTIFIER_LENGTH = 63
 
+    # Environment variable overriding PollingInterval
+    POLLING_INTERVAL_ENV = 'OS_POLLING_INTERVAL'
+
+    # Smoothing factor of the moving average of the cycle durations
+    DURATION_EMA_ALPHA = 0.3
+    # With AdaptiveInterval, the cycles are spaced by at least BACKOFF_FACTOR
+    # times their average duration, up to MAX_BACKOFF polling intervals
+    BACKOFF_FACTOR = 2
+    MAX_BACKOFF = 10
+
+    # Plugins of the process spreading their cycles with Stagger, in the
+    # order of their first read
+    _staggered = []
+    _staggered_lock = threading.Lock()
+
     def __init__(self, collectd, service_name=None, local_check=True):
         self.debug = False
         self.timeout = 5
@@ -48,6 +545,45 @@ class Base(object):
         self.service_name = service_name
         self.local_check = local_check
         self.polling_interval = 60
+        self.batch_dispatch = False
+        self.self_metrics = True
+        self.stats = Instrumentation()
+        self._dispatched = 0
+        self.adaptive_interval = False
+        self.effective_interval = None
+        self._duration_ema = None
+        self._last_cycle_start = None
+        self._cycle_lock = threading.Lock()
+        # With Stagger, the cycles start at a phase of the polling interval
+        # derived from the hostname and the plugin, plus up to Jitter seconds
+        self.stagger = False
+        self.jitter = 0
+        self._pending_cycle = None
+        # With AsyncCollection, the cycles run in the engine threads and
+        # what they dispatch is queued until the next read callback
+        self.async_collection = False
+        self.engine_workers = 4
+        self._engine_job = None
+        self._collected = queue.Queue()
+        self._local = threading.local()
+        self._dispatch_time = 0
+        # With OutOfProcess, the cycles run in a process of their own
+        # started with WorkerPython, see ProcessWorker
+        self.out_of_process = False
+        self.worker_python = 'python'
+        self._config = None
+        self._worker = None
+        # With SnapshotDir, the values of a successful cycle are written to
+        # a file at most every SnapshotInterval seconds and dispatched as
+        # stale by the first read after a restart, see load_snapshot()
+        self.snapshot_dir = None
+        self.snapshot_interval = 300
+        self.snapshot_max_age = 3600
+        self._snapshot_saved_at = 0
+        self._warm_start = True
+        # Values objects reused by dispatch_metrics(), indexed by type
+        self._templates = {}
+        self._checked_identifiers = set()
 
     def config_callback(self, conf):
         for node in conf.children:
@@ -60,14 +596,235 @@ class Base(object):
                 self.max_retries = int(node.values[0])
             elif node.key == 'PollingInterval':
                 self.polling_interval = int(node.values[0])
+            elif node.key == 'BatchDispatch':
+                self.batch_dispatch = node.values[0] in [True, 'True', 'true']
+            elif node.key == 'SelfMetrics':
+                self.self_metrics = node.values[0] in [True, 'True', 'true']
+            elif node.key == 'AdaptiveInterval':
+                self.adaptive_interval = node.values[0] in [True, 'True',
+                                                            'true']
+            elif node.key == 'Stagger':
+                self.stagger = node.values[0] in [True, 'True', 'true']
+            elif node.key == 'Jitter':
+                self.jitter = float(node.values[0])
+            elif node.key == 'AsyncCollection':
+                self.async_collection = node.values[0] in [True, 'True',
+                                                           'true']
+            elif node.key == 'EngineWorkers':
+                self.engine_workers = int(node.values[0])
+            elif node.key == 'OutOfProcess':
+                self.out_of_process = node.values[0] in [True, 'True', 'true']
+            elif node.key == 'WorkerPython':
+                self.worker_python = node.values[0]
+            elif node.key == 'SnapshotDir':
+                self.snapshot_dir = node.values[0] or None
+            elif node.key == 'SnapshotInterval':
+                self.snapshot_interval = int(node.values[0])
+            elif node.key == 'SnapshotMaxAge':
+                self.snapshot_max_age = int(node.values[0])
 
-        self.polling_interval = int(os.getenv('OS_POLLING_INTERVAL', self.polling_interval))
+        self.polling_interval = int(os.getenv(self.POLLING_INTERVAL_ENV, self.polling_interval))
         self.timeout = int(os.getenv('OS_TIMEOUT', self.timeout))
+        self.effective_interval = self.polling_interval
+        self._config = config_to_dict(conf)
+        if self.stagger:
+            self.register_stagger()
         
     def read_callback(self):
+        """Start a collection cycle, delayed to the phase of the plugin with
+        Stagger
+
+        The delayed cycle runs in its own thread so that the read threads of
+        collectd aren't held while waiting. With AsyncCollection, the values
+        collected since the previous call are dispatched first.
+
+        With SnapshotDir, the first call dispatches the values of the last
+        snapshot and runs the cycle in its own thread.
+        """
+        if self.async_collection:
+            self.dispatch_collected()
+        warm_start = False
+        if self._warm_start:
+            self._warm_start = False
+            warm_start = self.snapshot_dir and self.load_snapshot()
+        if not self.stagger:
+            if warm_start and not self.async_collection:
+                self._pending_cycle = threading.Thread(target=self.start_cycle)
+                self._pending_cycle.daemon = True
+                self._pending_cycle.start()
+            else:
+                self.start_cycle()
+            return
+        if self._pending_cycle is not None and self._pending_cycle.is_alive():
+            self.skip_cycle('overlap')
+            return
+        self._pending_cycle = threading.Timer(self.schedule_delay(),
+                                              self.start_cycle)
+        self._pending_cycle.daemon = True
+        self._pending_cycle.start()
+
+    def start_cycle(self):
+        """Run a collection cycle, in an engine thread with AsyncCollection
+        """
+        if not self.async_collection:
+            self.read_cycle()
+        elif self._engine_job is not None and not self._engine_job.done:
+            self.skip_cycle('overlap')
+        else:
+            self._engine_job = get_engine(self.engine_workers).submit(
+                self.engine_cycle)
+
+    def engine_cycle(self):
+        """Run a collection cycle in an engine thread
+
+        The values and notifications dispatched by the cycle are recorded
+        and queued at the end of the cycle with its start time, for
+        dispatch_collected().
+        """
+        events = []
+        started_at = time.time()
+        self._local.events = events
+        try:
+            self.read_cycle()
+        finally:
+            self._local.events = None
+            self._collected.put((started_at, events))
+
+    def dispatch_collected(self):
+        """Dispatch what the cycles run by the engine have collected
+
+        The values are timestamped with the start of their cycle.
+        """
+        self._local.draining = True
+        try:
+            while True:
+                try:
+                    started_at, events = self._collected.get_nowait()
+                except queue.Empty:
+                    return
+                self._dispatch_time = started_at
+                metrics = [e for kind, e in events if kind == 'metric']
+                if self.batch_dispatch:
+                    self.dispatch_metrics(metrics)
+                else:
+                    for metric in metrics:
+                        self.dispatch_metric(metric)
+                for kind, args in events:
+                    if kind == 'notification':
+                        self.dispatch_notification(*args)
+        finally:
+            self._dispatch_time = 0
+            self._local.draining = False
+
+    def _recorded(self, kind, event):
+        """Record an event of an engine cycle, return False out of one"""
+        events = getattr(self._local, 'events', None)
+        if events is None:
+            return False
+        events.append((kind, event))
+        return True
+
+    def register_stagger(self):
+        """Reserve a phase of the polling interval for the plugin"""
+        with self._staggered_lock:
+            if self not in self._staggered:
+                self._staggered.append(self)
+
+    def unregister_stagger(self):
+        """Release the phase of a plugin which isn't called by collectd"""
+        with self._staggered_lock:
+            if self in self._staggered:
+                self._staggered.remove(self)
+
+    def schedule_delay(self, now=None):
+        """Return the number of seconds until the next start of a cycle
+
+        The phase of a plugin in the polling interval is derived from a hash
+        of the hostname, so that the collectors of different hosts don't
+        poll at the same time, and from the rank of the plugin among the
+        staggered plugins of the process, so that they are evenly spread
+        over the interval. Up to Jitter seconds are added at random to the
+        phase, the delay is always shorter than the polling interval so that
+        the cycle starts before the next read.
+        """
+        if now is None:
+            now = time.time()
+        self.register_stagger()
+        with self._staggered_lock:
+            rank = self._staggered.index(self)
+            count = len(self._staggered)
+        interval = float(self.polling_interval)
+        host_hash = zlib.crc32(socket.gethostname().encode('utf-8'))
+        phase = (host_hash & 0xffffffff) / 2.0 ** 32 * interval
+        phase += rank * interval / count
+        phase += random.uniform(0, self.jitter)
+        return (phase - now) % interval
+
+    def read_cycle(self):
+        """Run a collection cycle unless it should be skipped
+
+        A cycle is skipped when the previous one is still in progress or,
+        with AdaptiveInterval, when the cycles have been taking too long
+        and the effective interval has been stretched beyond the polling
+        interval.
+        """
+        if not self._cycle_lock.acquire(False):
+            self.skip_cycle('overlap')
+            return
+        try:
+            now = time.time()
+            # collectd calls back every polling interval so the next call
+            # after the effective interval has elapsed is within half a
+            # polling interval of it
+            if self.adaptive_interval and self._last_cycle_start and \
+                    now - self._last_cycle_start + \
+                    self.polling_interval / 2.0 < self.effective_interval:
+                self.skip_cycle('backoff')
+                return
+            self._last_cycle_start = now
+            self.run_cycle()
+        finally:
+            self._cycle_lock.release()
+
+    def skip_cycle(self, reason):
+        self.stats.incr('skipped_cycles', reason)
+        self.logger.info('{}: skipping collection cycle ({})'.format(
+            self.plugin, reason))
+        if self.self_metrics:
+            self.dispatch_metric({
+                'plugin_instance': 'collector_skipped_cycles',
+                'type': 'derive',
+                'type_instance': reason,
+                'values': self.stats.value('skipped_cycles', reason),
+            })
+
+    def update_effective_interval(self, duration):
+        if self._duration_ema is None:
+            self._duration_ema = duration
+        else:
+            self._duration_ema = (
+                self.DURATION_EMA_ALPHA * duration +
+                (1 - self.DURATION_EMA_ALPHA) * self._duration_ema)
+        self.effective_interval = min(
+            max(self.polling_interval,
+                self.BACKOFF_FACTOR * self._duration_ema),
+            self.MAX_BACKOFF * self.polling_interval)
+
+    def run_cycle(self):
+        started_at = time.time()
+        self._dispatched = 0
+        snapshot = None
         try:
-            for metric in self.itermetrics():
-                self.dispatch_metric(metric)
+            metrics = self.collect()
+            if self.snapshot_dir and started_at - self._snapshot_saved_at >= \
+                    self.snapshot_interval:
+                snapshot = []
+                metrics = self._keep(metrics, snapshot)
+            if self.batch_dispatch:
+                self.dispatch_metrics(metrics)
+            else:
+                for metric in metrics:
+                    self.dispatch_metric(metric)
         except CheckException as e:
             msg = '{}: {}'.format(self.plugin, e)
             self.logger.warning(msg)
@@ -78,6 +835,161 @@ class Base(object):
             self.dispatch_check_metric(self.FAIL, msg)
         else:
             self.dispatch_check_metric(self.OK)
+            if snapshot is not None:
+                self.save_snapshot(snapshot, started_at)
+
+        duration = time.time() - started_at
+        self.update_effective_interval(duration)
+        if self.self_metrics:
+            self.dispatch_self_metrics(duration)
+
+    @staticmethod
+    def _keep(metrics, kept):
+        for metric in metrics:
+            kept.append(metric)
+            yield metric
+
+    def snapshot_path(self):
+        return os.path.join(self.snapshot_dir,
+                            '{}.snapshot'.format(self.plugin))
+
+    def snapshot_state(self):
+        """Return what the plugin keeps across restarts, as JSON-friendly
+        objects. Nothing by default."""
+        return None
+
+    def restore_state(self, state):
+        """Restore the snapshot_state() of the snapshot file"""
+        pass
+
+    def save_snapshot(self, metrics, saved_at):
+        """Write the values of a successful cycle and the state of the
+        plugin to the snapshot file
+
+        The file is replaced atomically so that a restart never reads a
+        partial snapshot.
+        """
+        path = self.snapshot_path()
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            state = json.dumps(self.snapshot_state()).encode('utf-8')
+            payload = pack_metrics(metrics)
+            with open(tmp, 'wb') as f:
+                f.write(SNAPSHOT_HEADER.pack(
+                    SNAPSHOT_MAGIC, SNAPSHOT_VERSION, saved_at, len(state),
+                    len(payload)))
+                f.write(state)
+                f.write(payload)
+            os.rename(tmp, path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            self.logger.warning('{}: Cannot write the snapshot {}: {}'.format(
+                self.plugin, path, e))
+            return
+        self._snapshot_saved_at = saved_at
+        self.stats.incr('snapshot_writes')
+
+    def load_snapshot(self):
+        """Restore the state of the snapshot file and dispatch its values
+
+        The values are flagged with stale in meta and timestamped with the
+        current time. Snapshots older than SnapshotMaxAge are ignored.
+        Return True if the snapshot was dispatched.
+        """
+        path = self.snapshot_path()
+        try:
+            with open(path, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            # ValueError is raised for an empty file
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                self.logger.warning('{}: Cannot read the snapshot {}: {}'
+                                    .format(self.plugin, path, e))
+            return False
+
+        try:
+            (magic, version, saved_at, state_size,
+             size) = SNAPSHOT_HEADER.unpack_from(m)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError('unknown format')
+            if time.time() - saved_at > self.snapshot_max_age:
+                self.logger.info('{}: Ignoring the snapshot {} taken {}s ago'
+                                 .format(self.plugin, path,
+                                         int(time.time() - saved_at)))
+                return False
+            offset = SNAPSHOT_HEADER.size
+            state = json.loads(m[offset:offset + state_size].decode('utf-8'))
+            offset += state_size
+            metrics = list(unpack_metrics(m[offset:offset + size]))
+            self.restore_state(state)
+        except (struct.error, TypeError, ValueError, KeyError,
+                IndexError) as e:
+            self.logger.warning('{}: Ignoring the snapshot {}: {}'.format(
+                self.plugin, path, e))
+            return False
+        finally:
+            m.close()
+
+        self._local.draining = True
+        try:
+            stale = self._stale(metrics)
+            if self.batch_dispatch:
+                self.dispatch_metrics(stale)
+            else:
+                for metric in stale:
+                    self.dispatch_metric(metric)
+        finally:
+            self._local.draining = False
+        self.stats.incr('warm_start_values', '', len(metrics))
+        return True
+
+    @staticmethod
+    def _stale(metrics):
+        """Add stale to the meta of the metrics of unpack_metrics()"""
+        no_meta = {'stale': True}
+        for metric in metrics:
+            if isinstance(metric, tuple):
+                meta = metric[2]
+                if meta is None:
+                    meta = no_meta
+                meta['stale'] = True
+                yield (metric[0], metric[1], meta)
+            else:
+                metric.setdefault('meta', {})['stale'] = True
+                yield metric
+
+    def dispatch_self_metrics(self, duration):
+        """Dispatch the metrics about the plugin's own behaviour
+
+        They are the duration and the number of values dispatched by the
+        last read cycle, the effective interval between cycles plus the
+        cumulative counters and histograms recorded in self.stats.
+        """
+        dispatched = self._dispatched
+        self.dispatch_metric({
+            'plugin_instance': 'collector_cycle_duration',
+            'type': 'response_time',
+            'values': duration,
+        })
+        self.dispatch_metric({
+            'plugin_instance': 'collector_dispatched_values',
+            'values': dispatched,
+        })
+        self.dispatch_metric({
+            'plugin_instance': 'collector_effective_interval',
+            'values': self.effective_interval,
+        })
+        for metric in self.stats.itermetrics():
+            self.dispatch_metric(metric)
+
+    def collect(self):
+        """Return the metrics of a read cycle, itermetrics() by default"""
+        if self.out_of_process:
+            if self._worker is None:
+                self._worker = ProcessWorker(
+                    self.worker_python, self.__class__.__module__,
+                    self._config, self.logger)
+            return self._worker.collect(self, self.polling_interval)
+        return self.itermetrics()
 
     def itermetrics(self):
         """Iterate over the collected metrics
@@ -99,6 +1011,14 @@ class Base(object):
             {'type_instance':'bar', 'type': 'DERIVE', 'values': 1,
                 'meta':   {'tagA': 'valA'}}
             {'type': 'dropped_bytes', 'values': [1,2]}
+
+        A metric can also be yielded as a compact tuple for the most common
+        case of a gauge without type_instance:
+            (plugin_instance, values) or (plugin_instance, values, meta)
+
+        For example:
+
+            ('used_ram_MB', 1024, {'host': 'compute-1'})
         """
         raise NotImplemented("Must be implemented by the subclass!")
 
@@ -115,19 +1035,42 @@ class Base(object):
 
         self.dispatch_metric(metric)
 
+    def dispatch_notification(self, message, severity, plugin_instance='',
+                              type_instance=''):
+        """Dispatch a collectd notification
+
+        severity is one of the collectd.NOTIF_* constants.
+        """
+        if self._recorded('notification', (message, severity,
+                                           plugin_instance, type_instance)):
+            return
+        n = self.collectd.Notification(
+            plugin=self.plugin,
+            plugin_instance=plugin_instance,
+            type_instance=type_instance,
+            message=message,
+            severity=severity,
+        )
+        n.dispatch()
+
     def dispatch_metric(self, metric):
+        if self._recorded('metric', metric):
+            self._dispatched += 1
+            return
+        if isinstance(metric, tuple):
+            metric = self._tuple_to_dict(metric)
+
         values = metric['values']
         if not isinstance(values, list) and not isinstance(values, tuple):
             values = (values,)
 
         type_instance = str(metric.get('type_instance', ''))
-        if len(type_instance) > self.MAX_IDENTIFIER_LENGTH:
-            self.logger.warning(
-                '%s: Identifier "%s..." too long (length: %d, max limit: %d)' %
-                (self.plugin, type_instance[:24], len(type_instance),
-                 self.MAX_IDENTIFIER_LENGTH))
+        self._check_identifier(type_instance)
 
         plugin_instance = metric.get('plugin_instance', self.plugin_instance)
+        # The interval is always set: the values dispatched from a thread of
+        # the plugin (with Stagger or after a warm start) have no read
+        # callback to take it from
         v = self.collectd.Values(
             plugin=self.plugin,
             host=metric.get('hostname', ''),
@@ -135,7 +1078,81 @@ class Base(object):
             plugin_instance=plugin_instance,
             type_instance=type_instance,
             values=values,
-            meta=metric.get('meta', {'0': True})
+            meta=metric.get('meta', {'0': True}),
+            interval=metric.get('interval', self.polling_interval),
+            time=self._dispatch_time
         )
         v.dispatch()
+        if not getattr(self._local, 'draining', False):
+            self._dispatched += 1
+
+    def dispatch_metrics(self, metrics):
+        """Dispatch an iterable of metrics, reusing one Values object per type
+
+        Only the fields which differ from one metric to the other are
+        updated before each dispatch and the identifiers are checked once.
+        """
+        events = getattr(self._local, 'events', None)
+        if events is not None:
+            count = len(events)
+            events.extend(('metric', metric) for metric in metrics)
+            self._dispatched += len(events) - count
+            return
+
+        count = 0
+        for metric in metrics:
+            if isinstance(metric, tuple):
+                metric_type = 'gauge'
+                type_instance = ''
+                hostname = ''
+                plugin_instance = metric[0]
+                values = metric[1]
+                meta = metric[2] if len(metric) > 2 else None
+                interval = self.polling_interval
+            else:
+                metric_type = metric.get('type', 'gauge')
+                type_instance = str(metric.get('type_instance', ''))
+                hostname = metric.get('hostname', '')
+                plugin_instance = metric.get('plugin_instance',
+                                             self.plugin_instance)
+                values = metric['values']
+                meta = metric.get('meta')
+                interval = metric.get('interval', self.polling_interval)
+                if type_instance not in self._checked_identifiers:
+                    self._check_identifier(type_instance)
+
+            v = self._templates.get(metric_type)
+            if v is None:
+                v = self.collectd.Values(plugin=self.plugin, type=metric_type,
+                                         interval=self.polling_interval)
+                self._templates[metric_type] = v
+
+            if type(values) not in (list, tuple):
+                values = (values,)
+            v.host = hostname
+            v.plugin_instance = plugin_instance
+            v.type_instance = type_instance
+            v.values = values
+            v.meta = meta or {'0': True}
+            v.interval = interval
+            v.time = self._dispatch_time
+            v.dispatch()
+            count += 1
+        if not getattr(self._local, 'draining', False):
+            self._dispatched += count
+
+    def _check_identifier(self, type_instance):
+        if len(type_instance) > self.MAX_IDENTIFIER_LENGTH:
+            self.logger.warning(
+                '%s: Identifier "%s..." too long (length: %d, max limit: %d)' %
+                (self.plugin, type_instance[:24], len(type_instance),
+                 self.MAX_IDENTIFIER_LENGTH))
+        else:
+            self._checked_identifiers.add(type_instance)
 
+    @staticmethod
+    def _tuple_to_dict(metric):
+        d = {'plugin_instance': metric[0], 'values': metric[1]}
+        if len(metric) > 2 and metric[2] is not None:
+            d['meta'] = metric[2]
+        return d
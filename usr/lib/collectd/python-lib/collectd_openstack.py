@@ -15,57 +15,464 @@
 import datetime
 import dateutil.parser
 import dateutil.tz
+import functools
+import importlib
 import requests
+from requests.packages.urllib3 import connectionpool
 import simplejson as json
 import os
+import threading
+import time
+from urlparse import urlparse
+import weakref
+
+# ijson backends by order of speed, the C ones need the yajl library
+ijson = None
+for _backend in ('ijson.backends.yajl2_c', 'ijson.backends.yajl2_cffi',
+                 'ijson'):
+    try:
+        ijson = importlib.import_module(_backend)
+        break
+    except ImportError:
+        continue
 
 import collectd_base as base
 
 from collections import defaultdict
+from collections import OrderedDict
 
 INTERVAL = 180
 
+# JSON decoders by order of preference, see get_json_decoder()
+JSON_DECODERS = ('ujson', 'rapidjson', 'simplejson', 'json')
+
 
 class KeystoneException(Exception):
     pass
 
+
+class SharedCredentials(object):
+    """ Keystone token and service catalog shared by all the OSClient
+    instances of the process which use the same credentials.
+
+    The python plugin is loaded with 'Globals true' so every plugin module
+    lives in the same interpreter and can reuse a single token instead of
+    authenticating on its own. The catalog holds the endpoints of all the
+    regions so that the clients of different regions share it too.
+    """
+
+    def __init__(self):
+        self.token = None
+        self.tenant_id = None
+        self.valid_until = None
+        self.expires_at = None
+        self.service_catalog = []
+        # Held by the thread which is refreshing the token
+        self.refresh_lock = threading.Lock()
+
+
+_shared_credentials = {}
+_shared_credentials_lock = threading.Lock()
+
+
+def get_shared_credentials(keystone_url, username, tenant, domain):
+    """ Return the SharedCredentials registered for the given identity,
+    creating it on first use.
+    """
+    key = (keystone_url, username, tenant, domain)
+    with _shared_credentials_lock:
+        if key not in _shared_credentials:
+            _shared_credentials[key] = SharedCredentials()
+        return _shared_credentials[key]
+
+
+class CircuitBreaker(object):
+    """ Track the health of an API endpoint to fail fast while it is down
+
+    The breaker opens after 'threshold' consecutive failures. While it is
+    open, the requests to the endpoint are refused without being sent.
+    After 'reset_timeout' seconds, it becomes half-open: a single request
+    is let through to probe the endpoint and closes the breaker if it
+    succeeds or opens it again if it fails.
+    """
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(endpoint, threshold, reset_timeout):
+    """ Return the CircuitBreaker of an endpoint (scheme://host:port)
+
+    The breakers are shared by all the plugins of the process, the first
+    plugin reaching an endpoint sets the thresholds of its breaker.
+    """
+    with _circuit_breakers_lock:
+        if endpoint not in _circuit_breakers:
+            _circuit_breakers[endpoint] = CircuitBreaker(threshold,
+                                                         reset_timeout)
+        return _circuit_breakers[endpoint]
+
+
+_worker_pools = {}
+_target_limits = {}
+_targets_lock = threading.Lock()
+
+
+def get_worker_pool(name, size):
+    """ Return the WorkerPool shared by all the plugins under a name
+
+    The pool grows to the largest size requested.
+    """
+    with _targets_lock:
+        pool = _worker_pools.get(name)
+        if pool is None:
+            pool = _worker_pools[name] = base.WorkerPool(size, name=name)
+        else:
+            pool.size = max(pool.size, size)
+        return pool
+
+
+class TargetLimit(object):
+    """ Bound the number of concurrent polls of a target
+
+    Unlike a semaphore, no thread waits for a slot: a job submitted while
+    the target is at its limit is set aside and queued on its pool when a
+    running poll of the target releases its slot.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._running = 0
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def submit(self, pool, job):
+        """ Queue the job on the pool now or once a slot is released """
+        with self._lock:
+            if self._running >= self.limit:
+                self._pending.append((pool, job))
+                return
+            self._running += 1
+        pool.put(job)
+
+    def release(self):
+        """ Must be called by a job of the target when it returns """
+        with self._lock:
+            if not self._pending:
+                self._running -= 1
+                return
+            # The slot is handed over to the oldest pending job
+            pool, job = self._pending.pop(0)
+        pool.put(job)
+
+
+def get_target_limit(target, limit):
+    """ Return the TargetLimit bounding the concurrent polls of a target
+
+    The limits are shared by all the plugins of the process, the first
+    plugin polling a target sets its limit. None is returned without limit.
+    """
+    if not limit:
+        return None
+    with _targets_lock:
+        if target not in _target_limits:
+            _target_limits[target] = TargetLimit(limit)
+        return _target_limits[target]
+
+
+def get_json_decoder(name=None):
+    """ Return the name and the loads() function of a JSON decoder
+
+    The given decoder is used if it can be imported, otherwise the first
+    available one in JSON_DECODERS. simplejson is skipped when it has been
+    installed without its C extension.
+    """
+    for candidate in ((name,) if name else ()) + JSON_DECODERS:
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            continue
+        if candidate == 'simplejson' and candidate != name and \
+                getattr(module.scanner, 'c_make_scanner', None) is None:
+            continue
+        return candidate, module.loads
+
+
+class WorkerStateStore(object):
+    """ Snapshots of the state of the OpenStack workers shared by all the
+    plugins of the process
+
+    A snapshot is reused by the plugins reading it during the same polling
+    interval (the time is split in buckets of the caller's interval) so
+    that the workers of a service are requested once per interval whatever
+    the number of plugins consuming them.
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, interval, fetch):
+        """ Return (workers, fetched_at, hit)
+
+        fetch() is called to refresh the snapshot if it was taken during a
+        previous interval. Concurrent callers wait for the refresh instead
+        of sending their own request.
+        """
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            now = time.time()
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and \
+                    int(snapshot[0] // interval) == int(now // interval):
+                return snapshot[1], snapshot[0], True
+            workers = fetch()
+            self._snapshots[key] = (now, workers)
+            return workers, now, False
+
+
+worker_states = WorkerStateStore()
+
+
+class BoundedWaitPool(object):
+    """ Mixin of the connection pools of PoolTimeoutAdapter
+
+    urllib3 waits forever for a connection of an exhausted blocking pool
+    unless urlopen() is given a pool_timeout, which requests never passes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.pool_timeout = kwargs.pop('pool_timeout', None)
+        super(BoundedWaitPool, self).__init__(*args, **kwargs)
+
+    def urlopen(self, *args, **kwargs):
+        if kwargs.get('pool_timeout') is None:
+            kwargs['pool_timeout'] = self.pool_timeout
+        return super(BoundedWaitPool, self).urlopen(*args, **kwargs)
+
+
+class BoundedWaitHTTPConnectionPool(BoundedWaitPool,
+                                    connectionpool.HTTPConnectionPool):
+    pass
+
+
+class BoundedWaitHTTPSConnectionPool(BoundedWaitPool,
+                                     connectionpool.HTTPSConnectionPool):
+    pass
+
+
+class PoolTimeoutAdapter(requests.adapters.HTTPAdapter):
+    """ HTTPAdapter whose requests wait at most pool_timeout seconds for a
+    connection when the pool is exhausted and blocks (pool_block), the
+    request then fails with an EmptyPoolError.
+    """
+
+    def __init__(self, pool_timeout=None, **kwargs):
+        # Read by init_poolmanager(), called by the parent constructor
+        self.pool_timeout = pool_timeout
+        super(PoolTimeoutAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PoolTimeoutAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': functools.partial(BoundedWaitHTTPConnectionPool,
+                                      pool_timeout=self.pool_timeout),
+            'https': functools.partial(BoundedWaitHTTPSConnectionPool,
+                                       pool_timeout=self.pool_timeout),
+        }
+
+
 class OSClient(object):
     """ Base class for querying the OpenStack API endpoints.
 
     It uses the Keystone service catalog to discover the API endpoints.
+    The token and the catalog are kept in a SharedCredentials object so
+    that all the clients using the same credentials authenticate once.
     """
     EXPIRATION_TOKEN_DELTA = datetime.timedelta(0, 30)
 
     def __init__(self, username, password, tenant, domain, region, keystone_url, timeout,
-                 logger, max_retries):
+                 logger, max_retries, stats=None, breaker_threshold=3,
+                 breaker_timeout=60, pool_maxsize=10, pool_block=False,
+                 service_pool_sizes=None, json_decoder=None):
         self.logger = logger
+        self.stats = stats or base.Instrumentation()
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        # Circuit breakers of the endpoints reached by this client
+        self.circuit_breakers = {}
         self.username = username
         self.password = password
         self.tenant_name = tenant
         self.domain = domain
         self.region = region
         self.keystone_url = keystone_url
-        self.service_catalog = []
-        self.tenant_id = None
+        self.credentials = get_shared_credentials(
+            keystone_url, username, tenant, domain)
+        # Entries of the shared catalog for the client's region, indexed by
+        # service name and type, and number of catalogs indexed so far
+        self._catalog_source = None
+        self._service_catalog = []
+        self._service_index = {}
+        self.catalog_version = 0
         self.timeout = timeout
-        self.token = None
-        self.valid_until = None
+        self.max_retries = max_retries
+        self.json_decoder, self.json_loads = get_json_decoder(json_decoder)
+        if json_decoder and json_decoder != self.json_decoder:
+            self.logger.warning("JSON decoder '{}' not available, using "
+                                "'{}'".format(json_decoder, self.json_decoder))
+        # Connections kept alive per host, by default and by service name
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.service_pool_sizes = service_pool_sizes or {}
         self.session = requests.Session()
-        self.session.mount(
-            'http://', requests.adapters.HTTPAdapter(max_retries=max_retries))
-        self.session.mount(
-            'https://', requests.adapters.HTTPAdapter(max_retries=max_retries))
+        self.session.mount('http://', self.http_adapter(pool_maxsize))
+        self.session.mount('https://', self.http_adapter(pool_maxsize))
+        # Number of connections opened by each pool when last seen, see
+        # count_connections()
+        self._pool_connections = weakref.WeakKeyDictionary()
+        self._pool_lock = threading.Lock()
+
+    @property
+    def token(self):
+        return self.credentials.token
+
+    @property
+    def tenant_id(self):
+        return self.credentials.tenant_id
+
+    @property
+    def valid_until(self):
+        return self.credentials.valid_until
+
+    @property
+    def service_catalog(self):
+        """ The catalog entries of the client's region
+
+        Without region, the first entry found for each service is used.
+        """
+        self._index_catalog()
+        return self._service_catalog
+
+    @property
+    def service_index(self):
+        """ The entries of service_catalog by service name and by type """
+        self._index_catalog()
+        return self._service_index
+
+    def _index_catalog(self):
+        """ Select and index the entries of the client's region once per
+        catalog received from Keystone """
+        source = self.credentials.service_catalog
+        if source is self._catalog_source:
+            return
+        if self.region is None:
+            catalog = OrderedDict()
+            for entry in source:
+                catalog.setdefault(entry['name'], entry)
+            catalog = list(catalog.values())
+        else:
+            catalog = [entry for entry in source
+                       if entry['region'] == self.region]
+        index = {}
+        for entry in catalog:
+            index.setdefault(entry['service_type'], entry)
+        for entry in catalog:
+            index[entry['name']] = entry
+        self._service_catalog = catalog
+        self._service_index = index
+        self.catalog_version += 1
+        self._catalog_source = source
 
     def is_valid_token(self):
         now = datetime.datetime.now(tz=dateutil.tz.tzutc())
         return self.token and self.valid_until and self.valid_until > now
 
+    def is_usable_token(self):
+        """ Return True if the token hasn't expired yet, even if it is due
+        for renewal.
+        """
+        now = datetime.datetime.now(tz=dateutil.tz.tzutc())
+        expires_at = self.credentials.expires_at
+        return self.token and expires_at and expires_at > now
+
     def clear_token(self):
-        self.token = None
-        self.valid_until = None
+        self.credentials.token = None
+        self.credentials.valid_until = None
+        self.credentials.expires_at = None
+
+    def ensure_token(self):
+        """ Return a valid token, renewing the shared one if needed.
+
+        Only one thread renews the token at a time. While the renewal is in
+        progress, the other threads keep on using the current token as long
+        as it hasn't expired yet, otherwise they wait for the renewal.
+        """
+        if self.is_valid_token():
+            return self.token
+
+        lock = self.credentials.refresh_lock
+        if self.is_usable_token():
+            if not lock.acquire(False):
+                return self.token
+        else:
+            lock.acquire()
+        try:
+            if self.is_valid_token():
+                # Another thread renewed the token while we were waiting
+                return self.token
+            return self._get_token()
+        finally:
+            lock.release()
 
     def get_token(self):
-        self.clear_token()
+        with self.credentials.refresh_lock:
+            return self._get_token()
+
+    def _get_token(self):
         data = json.dumps({ 
             "auth": {
                 "identity": {
@@ -87,9 +494,11 @@ class OSClient(object):
             }
         })        
         self.logger.error("Trying to get token from '%s'" % self.keystone_url)
+        self.stats.incr('token_refreshes')
         r = self.make_request('post',
                               '%s/auth/tokens' % self.keystone_url, data=data,
-                              token_required=False)
+                              token_required=False,
+                              stats_key=('keystone', 'auth/tokens'))
         if not r:
             raise KeystoneException("Cannot get a valid token from %s" %
                                     self.keystone_url)
@@ -98,55 +507,68 @@ class OSClient(object):
             raise KeystoneException("%s responded with code %d" %
                                     (self.keystone_url, r.status_code))
 
-        data = r.json()
+        data = self.parse_json(r, 'keystone', 'auth/tokens')
         self.logger.debug("Got response from Keystone: '%s'" % data)
-        self.token = r.headers.get("X-Subject-Token") 
-        self.tenant_id = data['token']['project']['id']
-        self.valid_until = dateutil.parser.parse(
-            data['token']['expires_at']) - self.EXPIRATION_TOKEN_DELTA
-        self.service_catalog = []
+        # The catalog keeps the endpoints of all the regions, each client
+        # filters the entries of its own region (see service_catalog)
+        service_catalog = []
         for item in data['token']['catalog']:
-            internalURL = None
-            publicURL = None
-            adminURL = None
+            regions = OrderedDict()
             for endpoint in item['endpoints']:
-                if endpoint['region'] == self.region or self.region is None:
-                    if endpoint['interface'] == 'internal':
-                        internalURL = endpoint['url']
-                    elif endpoint['interface'] == 'public':
-                        publicURL = endpoint['url']
-                    elif endpoint['interface'] == 'admin':
-                        adminURL = endpoint['url']
-                        
-            if internalURL is None and publicURL is None:
-                self.logger.warning(
-                    "Service '{}' skipped because no URL can be found".format(
-                        item['name']))
-                continue
-            self.service_catalog.append({
-                'name': item['name'],
-                'region': self.region,
-                'service_type': item['type'],
-                'url': internalURL if internalURL is not None else publicURL,
-                'admin_url': adminURL,
-            })
+                urls = regions.setdefault(endpoint['region'], {})
+                urls[endpoint['interface']] = endpoint['url']
+
+            for region, urls in regions.items():
+                internalURL = urls.get('internal')
+                publicURL = urls.get('public')
+                if internalURL is None and publicURL is None:
+                    self.logger.warning(
+                        "Service '{}' skipped in region '{}' because no URL "
+                        "can be found".format(item['name'], region))
+                    continue
+                service_catalog.append({
+                    'name': item['name'],
+                    'region': region,
+                    'service_type': item['type'],
+                    'url': internalURL if internalURL is not None else publicURL,
+                    'admin_url': urls.get('admin'),
+                })
+
+        expires_at = dateutil.parser.parse(data['token']['expires_at'])
+        credentials = self.credentials
+        credentials.service_catalog = service_catalog
+        credentials.tenant_id = data['token']['project']['id']
+        credentials.expires_at = expires_at
+        credentials.valid_until = expires_at - self.EXPIRATION_TOKEN_DELTA
+        credentials.token = r.headers.get("X-Subject-Token")
 
         self.logger.debug("Got token '%s'" % self.token)
         return self.token
 
     def make_request(self, verb, url, data=None, token_required=True,
-                     params=None):
+                     params=None, headers=None, stream=False,
+                     stats_key=None):
+        """ Send a request and return the response, None on failure
+
+        The request is accounted in self.stats under stats_key, a
+        (service, resource) tuple.
+        """
         kwargs = {
             'url': url,
             'timeout': self.timeout,
-            'headers': {'Content-type': 'application/json'}
+            'headers': {'Content-type': 'application/json',
+                        'Accept-Encoding': 'gzip, deflate'}
         }
-        if token_required and not self.is_valid_token() and \
-           not self.get_token():
-            self.logger.error("Aborting request, no valid token")
-            return
-        elif token_required:
-            kwargs['headers']['X-Auth-Token'] = self.token
+        if headers is not None:
+            kwargs['headers'].update(headers)
+        if stream:
+            kwargs['stream'] = True
+        if token_required:
+            token = self.ensure_token()
+            if not token:
+                self.logger.error("Aborting request, no valid token")
+                return
+            kwargs['headers']['X-Auth-Token'] = token
 
         if data is not None:
             kwargs['data'] = data
@@ -154,25 +576,127 @@ class OSClient(object):
         if params is not None:
             kwargs['params'] = params
 
+        if stats_key is not None:
+            self.mount_service(url, stats_key[0])
         func = getattr(self.session, verb.lower())
+        key = self.stats_key(stats_key)
+
+        breaker = self.circuit_breaker(url)
+        if breaker is not None and not breaker.allow_request():
+            self.stats.incr('http_short_circuited', key)
+            self.logger.warning("Skipping request to '%s', the endpoint is "
+                                "failing" % url)
+            return
 
+        started_at = time.time()
         try:
             r = func(**kwargs)
         except Exception as e:
+            if breaker is not None:
+                breaker.record_failure()
+            self.stats.incr('http_errors', key)
             self.logger.error("Got exception for '%s': '%s'" %
                               (kwargs['url'], e))
             return
+        finally:
+            duration = time.time() - started_at
+            self.stats.incr('http_requests', key)
+            self.stats.incr('http_duration_ms', key, int(duration * 1000))
+            self.stats.observe('http_duration', key, duration)
+
+        if breaker is not None:
+            if r.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+        retries = getattr(getattr(r.raw, 'retries', None), 'history', None)
+        if retries:
+            self.stats.incr('http_retries', key, len(retries))
+        self.count_connections(r, key)
+        if not stream:
+            # Bytes received on the wire, before decompression
+            if hasattr(r.raw, 'tell'):
+                self.stats.incr('http_received_bytes', key, r.raw.tell())
+            else:
+                self.stats.incr('http_received_bytes', key, len(r.content))
 
         self.logger.info("%s responded with status code %d" %
                          (kwargs['url'], r.status_code))
-        if r.status_code == 401:
+        if r.status_code == 401 and token_required:
             # Clear token in case it is revoked or invalid
             self.clear_token()
 
         return r
 
+    def http_adapter(self, pool_maxsize):
+        # With pool_block, a request waits up to the timeout for a free
+        # connection of the pool instead of forever
+        return PoolTimeoutAdapter(pool_timeout=self.timeout,
+                                  max_retries=self.max_retries,
+                                  pool_maxsize=pool_maxsize,
+                                  pool_block=self.pool_block)
+
+    def mount_service(self, url, service):
+        """ Mount an adapter sized for the service on its endpoint, if the
+            service has its own pool size.
+        """
+        size = self.service_pool_sizes.get(service)
+        if size is None:
+            return
+        u = urlparse(url)
+        prefix = '{}://{}/'.format(u.scheme, u.netloc)
+        with self._pool_lock:
+            if prefix not in self.session.adapters:
+                self.session.mount(prefix, self.http_adapter(size))
+
+    def count_connections(self, r, key):
+        """ Account the request as sent on a new or a kept-alive connection
+
+            urllib3 counts the connections opened by each pool, any increase
+            since the previous request of the pool is a new connection.
+        """
+        pool = getattr(r.raw, '_pool', None)
+        if pool is None:
+            return
+        with self._pool_lock:
+            new = pool.num_connections - self._pool_connections.get(pool, 0)
+            self._pool_connections[pool] = pool.num_connections
+        if new > 0:
+            self.stats.incr('http_new_connections', key, new)
+        else:
+            self.stats.incr('http_reused_connections', key)
+
+    def circuit_breaker(self, url):
+        if not self.breaker_threshold:
+            return None
+        u = urlparse(url)
+        endpoint = '{}://{}'.format(u.scheme, u.netloc)
+        if endpoint not in self.circuit_breakers:
+            self.circuit_breakers[endpoint] = get_circuit_breaker(
+                endpoint, self.breaker_threshold, self.breaker_timeout)
+        return self.circuit_breakers[endpoint]
+
+    @staticmethod
+    def stats_key(stats_key):
+        if stats_key is None:
+            return 'other'
+        service, resource = stats_key
+        return '{}.{}'.format(service, resource.replace('/', '_'))
+
+    def parse_json(self, r, service, resource):
+        """ Decode the JSON body of a response and account the time spent
+        """
+        started_at = time.time()
+        try:
+            return self.json_loads(r.content)
+        finally:
+            self.stats.incr('json_parse_ms', self.stats_key((service, resource)),
+                            int((time.time() - started_at) * 1000))
+
 
 class CollectdPlugin(base.Base):
+    CHANGES_SINCE_MARGIN = datetime.timedelta(0, 60)
 
     def __init__(self, *args, **kwargs):
         super(CollectdPlugin, self).__init__(*args, **kwargs)
@@ -182,10 +706,60 @@ class CollectdPlugin(base.Base):
         self.extra_config = {}
         self._threads = {}
         self.pagination_limit = None
-        self._last_run = None
-        self.changes_since = False
+        # Incremental fetching, see get_incremental(): query parameter
+        # indexed by resource, time of the last successful run and snapshot
+        # indexed by (service, resource)
+        self.changes_since = {}
+        self.full_resync_interval = datetime.timedelta(0, 3600)
+        self._last_run = {}
+        self._snapshots = {}
+        # Consecutive failures opening the circuit breaker of an endpoint
+        # (0 disables the breakers) and seconds before probing it again
+        self.breaker_threshold = 3
+        self.breaker_timeout = 60
+        # With DeltaMode, the worker states are reported when they change
+        # and every HeartbeatInterval seconds otherwise
+        self.delta_mode = False
+        self.heartbeat_interval = 300
+        self.state_tracker = None
+        # Age of the worker snapshots read by iter_workers(), by service
+        self._snapshot_ages = {}
+        # TTL in seconds of the cached responses, indexed by resource
+        self.cache_ttl = {}
+        self._cache = {}
+        # Name of the JSON decoder, the fastest available one by default
+        self.json_decoder = None
+        # Size of the HTTP connection pools, by default and by service
+        self.pool_maxsize = 10
+        self.pool_block = False
+        self.service_pool_sizes = {}
+        # Settings of a plugin polling a single target (a region of a
+        # cloud) on behalf of the plugin polling several ones, which holds
+        # the (meta, plugin, limit) of its targets, see
+        # configure_targets()
+        self.target = None
+        self._targets = []
+        self._target_pool = None
+        self.target_workers = 16
+        self.target_stagger = 0
+        # URLs built by _build_url() and catalog version they come from
+        self._urls = {}
+        self._urls_version = None
 
     def _build_url(self, service, resource):
+        """ Return the URL of a resource of a service of the catalog
+
+        The URLs are built once per catalog.
+        """
+        if self._urls_version != self.os_client.catalog_version:
+            self._urls = {}
+            self._urls_version = self.os_client.catalog_version
+        key = (service, resource)
+        if key not in self._urls:
+            self._urls[key] = self._make_url(service, resource)
+        return self._urls[key]
+
+    def _make_url(self, service, resource):
         s = (self.get_service(service) or {})
         url = s.get('url')
         # v3 API must be used in order to obtain tenants in multi-domain envs
@@ -201,9 +775,15 @@ class CollectdPlugin(base.Base):
             self.logger.error("Service '%s' not found in catalog" % service)
         return url
 
-    def raw_get(self, url, token_required=False):
-        return self.os_client.make_request('get', url,
-                                           token_required=token_required)
+    def raw_get(self, url, token_required=False, service=None):
+        return self.os_client.make_request(
+            'get', url, token_required=token_required,
+            stats_key=(service or 'raw', 'probe'))
+
+    def raw_head(self, url, token_required=False, service=None):
+        return self.os_client.make_request(
+            'head', url, token_required=token_required,
+            stats_key=(service or 'raw', 'probe'))
 
     def iter_workers(self, service):
         """ Return the list of workers and their state
@@ -216,8 +796,79 @@ class CollectdPlugin(base.Base):
         }
 
         where 'state' can be 'up', 'down' or 'disabled'
+
+        The list comes from a snapshot shared by all the plugins of the
+        process: the workers of a service are requested at most once per
+        polling interval.
         """
+        workers, fetched_at, hit = worker_states.get(
+            (self.os_client.credentials, self.os_client.region, service),
+            self.polling_interval,
+            lambda: self._fetch_workers(service))
+        if hit:
+            self.stats.incr('worker_snapshot_hits', service)
+        else:
+            self.stats.incr('worker_snapshot_misses', service)
+        self._snapshot_ages[service] = time.time() - fetched_at
+
+        for data in workers or []:
+            yield dict(data)
+
+    def start_worker_states(self):
+        """ Must be called before iter_worker_state() in each cycle """
+        if self.state_tracker is not None:
+            self.state_tracker.start()
+
+    def end_worker_states(self):
+        """ Must be called after iter_worker_state() in each cycle """
+        if self.state_tracker is not None:
+            self.state_tracker.prune()
+
+    def iter_worker_state(self, plugin_instance, host, service, state,
+                          value):
+        """ Yield the metric of the state of a worker
 
+        With DeltaMode, the metric is only yielded when the state has
+        changed or when the heartbeat interval has elapsed. A state change
+        also yields a '<plugin_instance>_transition' metric whose value is
+        the number of seconds spent in the previous state and dispatches a
+        notification.
+        """
+        meta = {'host': host, 'service': service, 'state': state}
+        if self.state_tracker is None:
+            yield {'plugin_instance': plugin_instance, 'values': value,
+                   'meta': meta}
+            return
+
+        report, transition = self.state_tracker.update((host, service),
+                                                       state)
+        if report:
+            # The value is dispatched with the heartbeat interval so that
+            # collectd doesn't expire it (after Timeout intervals) between
+            # two heartbeats
+            yield {'plugin_instance': plugin_instance, 'values': value,
+                   'meta': meta,
+                   'interval': max(self.heartbeat_interval,
+                                   self.polling_interval)}
+        if transition is not None:
+            previous_state, duration = transition
+            yield {
+                'plugin_instance': '{}_transition'.format(plugin_instance),
+                'values': duration,
+                'meta': {'host': host, 'service': service, 'state': state,
+                         'previous_state': previous_state},
+            }
+            if state == 'up':
+                severity = self.collectd.NOTIF_OKAY
+            else:
+                severity = self.collectd.NOTIF_WARNING
+            self.dispatch_notification(
+                "{} on {} is {} (was {} for {}s)".format(
+                    service, host, state, previous_state, int(duration)),
+                severity, plugin_instance=plugin_instance,
+                type_instance=service)
+
+    def _fetch_workers(self, service):
         if service == 'neutron':
             endpoint = 'v2.0/agents'
             entry = 'agents'
@@ -225,64 +876,490 @@ class CollectdPlugin(base.Base):
             endpoint = 'os-services'
             entry = 'services'
 
-        ost_services_r = self.get(service, endpoint)
-
         msg = "Cannot get state of {} workers".format(service)
-        if ost_services_r is None:
-            self.logger.warning(msg)
-        elif ost_services_r.status_code != 200:
-            msg = "{}: Got {} ({})".format(
-                msg, ost_services_r.status_code, ost_services_r.content)
-            self.logger.warning(msg)
+        if endpoint in self.changes_since:
+            vals = self.get_incremental(
+                service, endpoint, entry,
+                key=lambda val: (val['host'], val['binary']))
+            if vals is None:
+                self.logger.warning(msg)
+                return
         else:
+            ost_services_r = self.get(service, endpoint)
+            if ost_services_r is None:
+                self.logger.warning(msg)
+                return
+            elif ost_services_r.status_code != 200:
+                msg = "{}: Got {} ({})".format(
+                    msg, ost_services_r.status_code, ost_services_r.content)
+                self.logger.warning(msg)
+                return
+
             try:
-                r_json = ost_services_r.json()
+                r_json = self.os_client.parse_json(ost_services_r, service,
+                                                   endpoint)
             except ValueError:
                 r_json = {}
 
             if entry not in r_json:
                 msg = "{}: couldn't find '{}' key".format(msg, entry)
                 self.logger.warning(msg)
+                return
+            vals = r_json[entry]
+
+        workers = []
+        for val in vals:
+            data = {'host': val['host'], 'service': val['binary']}
+
+            if service == 'neutron':
+                if not val['admin_state_up']:
+                    data['state'] = 'disabled'
+                else:
+                    data['state'] = 'up' if val['alive'] else 'down'
+            else:
+                if val['status'] == 'disabled':
+                    data['state'] = 'disabled'
+                elif val['state'] == 'up' or val['state'] == 'down':
+                    data['state'] = val['state']
+                else:
+                    msg = "Unknown state for {} workers:{}".format(
+                        service, val['state'])
+                    self.logger.warning(msg)
+                    continue
+
+            workers.append(data)
+        return workers
+
+    def get_incremental(self, service, resource, entry, key=None,
+                        params=None, headers=None, paginate=False,
+                        fields=None):
+        """ Return the items of a collection, fetching only the changes
+
+        When the resource is listed in ChangesSince, the plugin keeps a
+        snapshot of the collection and only requests the items changed
+        since the last successful run (minus CHANGES_SINCE_MARGIN to cover
+        clock skews) with the configured query parameter. The changed items
+        replace the ones with the same key (key(item), default item['id'])
+        and the deleted ones are removed. The whole collection is fetched
+        again every FullResyncInterval seconds to correct any drift. The
+        fields kept with the fields argument must include the key.
+
+        Otherwise it is the same as get_collection(). Returns None if the
+        collection can't be fetched.
+        """
+        param = self.changes_since.get(resource)
+        if param is None:
+            return self.get_collection(service, resource, entry,
+                                       params=params, headers=headers,
+                                       paginate=paginate, fields=fields)
+
+        if fields is not None:
+            # Needed to find the deleted items
+            fields = tuple(fields) + ('deleted', 'status')
+
+        key = key or (lambda item: item['id'])
+        run_at = datetime.datetime.now(tz=dateutil.tz.tzutc())
+        snapshot = self._snapshots.get((service, resource))
+        last_run = self._last_run.get((service, resource))
+        full = (snapshot is None or last_run is None or
+                run_at - snapshot['full_at'] >= self.full_resync_interval)
+
+        params = dict(params or {})
+        if not full:
+            since = last_run - self.CHANGES_SINCE_MARGIN
+            params[param] = since.strftime('%Y-%m-%dT%H:%M:%SZ')
+        items = self.get_collection(service, resource, entry, params=params,
+                                    headers=headers, paginate=paginate,
+                                    fields=fields)
+        if items is None:
+            return None
+
+        if full:
+            snapshot = {'items': OrderedDict(), 'full_at': run_at}
+        for item in items:
+            if item.get('deleted') or item.get('status') == 'DELETED':
+                snapshot['items'].pop(key(item), None)
             else:
-                for val in r_json[entry]:
-                    data = {'host': val['host'], 'service': val['binary']}
-
-                    if service == 'neutron':
-                        if not val['admin_state_up']:
-                            data['state'] = 'disabled'
-                        else:
-                            data['state'] = 'up' if val['alive'] else 'down'
-                    else:
-                        if val['status'] == 'disabled':
-                            data['state'] = 'disabled'
-                        elif val['state'] == 'up' or val['state'] == 'down':
-                            data['state'] = val['state']
-                        else:
-                            msg = "Unknown state for {} workers:{}".format(
-                                service, val['state'])
-                            self.logger.warning(msg)
-                            continue
-
-                    yield data
-
-    def get(self, service, resource, params=None):
+                snapshot['items'][key(item)] = item
+        self._snapshots[(service, resource)] = snapshot
+        self._last_run[(service, resource)] = run_at
+        self.stats.incr('full_fetches' if full else 'incremental_fetches',
+                        self.os_client.stats_key((service, resource)))
+        return list(snapshot['items'].values())
+
+    def get(self, service, resource, params=None, headers=None, stream=False):
+        if resource in self.cache_ttl:
+            return self._cached_get(service, resource, params, headers)
+
+        url = self._build_url(service, resource)
+        if not url:
+            return
+        self.logger.info('GET({}) {}'.format(url, params))
+        return self.os_client.make_request('get', url, params=params,
+                                           headers=headers, stream=stream,
+                                           stats_key=(service, resource))
+
+    def _cached_get(self, service, resource, params, headers):
+        """ GET a resource listed in CacheTTL
+
+        The response is served from the cache until its TTL expires. After
+        that, the request is revalidated with the ETag and Last-Modified
+        headers of the cached response when the API provided them.
+
+        The same response object is returned as long as the content doesn't
+        change so that callers can skip the processing of unchanged data by
+        comparing the returned object with the previous one.
+        """
+        key = (service, resource, tuple(sorted((params or {}).items())))
+        entry = self._cache.get(key)
+        now = time.time()
+        if entry and now - entry['fetched_at'] < self.cache_ttl[resource]:
+            return entry['response']
+
         url = self._build_url(service, resource)
         if not url:
             return
+
+        headers = dict(headers or {})
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
         self.logger.info('GET({}) {}'.format(url, params))
-        return self.os_client.make_request('get', url, params=params)
+        r = self.os_client.make_request('get', url, params=params,
+                                        headers=headers,
+                                        stats_key=(service, resource))
+        if entry and r is not None and r.status_code == 304:
+            entry['fetched_at'] = now
+            return entry['response']
+        if r is None or r.status_code != 200:
+            return r
+
+        if entry and entry['response'].content == r.content:
+            # The API doesn't support conditional requests
+            r = entry['response']
+        self._cache[key] = {
+            'response': r,
+            'fetched_at': now,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }
+        return r
+
+    def dump_cache(self):
+        """ Return the cached responses as JSON-friendly lists """
+        return [[list(key[:2]), [list(p) for p in key[2]],
+                 entry['response'].content.decode('utf-8'),
+                 entry['etag'], entry['last_modified']]
+                for key, entry in list(self._cache.items())]
+
+    def load_cache(self, cache):
+        """ Restore the cached responses of dump_cache()
+
+            They are revalidated by their first request so that a response
+            unchanged since the snapshot isn't downloaded again.
+        """
+        for (service, resource), params, content, etag, last_modified \
+                in cache:
+            if resource not in self.cache_ttl:
+                continue
+            r = requests.models.Response()
+            r.status_code = 200
+            r._content = content.encode('utf-8')
+            r._content_consumed = True
+            if etag:
+                r.headers['ETag'] = etag
+            if last_modified:
+                r.headers['Last-Modified'] = last_modified
+            key = (service, resource, tuple(tuple(p) for p in params))
+            self._cache[key] = {
+                'response': r,
+                'fetched_at': 0,
+                'etag': etag,
+                'last_modified': last_modified,
+            }
+
+    def snapshot_state(self):
+        return {
+            'cache': self.dump_cache(),
+            'targets': {json.dumps(meta, sort_keys=True): plugin.dump_cache()
+                        for meta, plugin, _ in self._targets},
+        }
+
+    def restore_state(self, state):
+        self.load_cache(state['cache'])
+        for meta, plugin, _ in self._targets:
+            plugin.load_cache(
+                state['targets'].get(json.dumps(meta, sort_keys=True), []))
+
+    def get_collection(self, service, resource, entry, params=None,
+                       headers=None, paginate=False, fields=None):
+        """ Return an iterator over the items of a collection
+
+        The response bodies are decoded incrementally when the ijson module
+        is available. When paginate is True and PaginationLimit is set, the
+        collection is fetched page after page using the limit/marker query
+        parameters so that only one page is held in memory at a time. The
+        API may return less items per page than the limit (Nova caps them
+        at osapi_max_limit) so the paging only stops on a page shorter than
+        the previous ones or empty.
+
+        When fields is given, the items only keep these fields so that the
+        rest of the decoded objects can be freed right away.
+
+        Returns None if the first request fails. A failure while fetching
+        the next pages raises a CheckException.
+        """
+        params = dict(params or {})
+        limit = self.pagination_limit if paginate else None
+        if limit:
+            params['limit'] = limit
+
+        r = self.get(service, resource, params=params, headers=headers,
+                     stream=True)
+        if not r:
+            if r is not None:
+                # Release the connection of the streamed error response
+                r.close()
+            return None
+        return self._iter_collection(r, service, resource, entry, params,
+                                     headers, limit, fields)
+
+    def _iter_collection(self, r, service, resource, entry, params, headers,
+                         limit, fields=None):
+        # Largest number of items returned in a page so far
+        page_size = 0
+        while True:
+            count = 0
+            last = None
+            try:
+                for item in self._iter_entries(r, service, resource, entry):
+                    count += 1
+                    last = item
+                    if fields is not None:
+                        item = {k: item[k] for k in fields if k in item}
+                    yield item
+            finally:
+                r.close()
+
+            if not limit or last is None or count < page_size:
+                return
+            page_size = max(page_size, count)
+
+            params['marker'] = last['id']
+            r = self.get(service, resource, params=params, headers=headers,
+                         stream=True)
+            if not r:
+                if r is not None:
+                    r.close()
+                raise base.CheckException(
+                    "Cannot get {} from {} after marker {}".format(
+                        resource, service, params['marker']))
+
+    def _iter_entries(self, r, service, resource, entry):
+        if ijson is None or resource in self.cache_ttl:
+            # Cached responses are already read
+            r_json = self.os_client.parse_json(r, service, resource)
+            return iter(r_json.get(entry, []))
+        return self._iter_stream(r, service, resource, entry)
+
+    def _iter_stream(self, r, service, resource, entry):
+        """ Decode the items of a response while it is being received
+
+        The time spent in reading and decoding the body is accounted as JSON
+        parse time.
+        """
+        stats = self.os_client.stats
+        key = self.os_client.stats_key((service, resource))
+        r.raw.decode_content = True
+        items = ijson.items(r.raw, '{}.item'.format(entry))
+        elapsed = 0
+        try:
+            while True:
+                started_at = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.time() - started_at
+                yield item
+        finally:
+            stats.incr('json_parse_ms', key, int(elapsed * 1000))
+            if hasattr(r.raw, 'tell'):
+                stats.incr('http_received_bytes', key, r.raw.tell())
+
+    @staticmethod
+    def parse_cloud(node):
+        """ Return the settings of a <Cloud "name"> block """
+        cloud = {'cloud': node.values[0], 'keystone_url': None,
+                 'username': None, 'password': None, 'tenant': None,
+                 'domain': None, 'regions': None, 'max_concurrency': 0}
+        for child in node.children:
+            if child.key == 'KeystoneUrl':
+                cloud['keystone_url'] = child.values[0]
+            elif child.key == 'Username':
+                cloud['username'] = child.values[0]
+            elif child.key == 'Password':
+                cloud['password'] = child.values[0]
+            elif child.key == 'Tenant':
+                cloud['tenant'] = child.values[0]
+            elif child.key == 'UserDomain':
+                cloud['domain'] = child.values[0]
+            elif child.key == 'Region':
+                cloud['regions'] = ','.join(child.values)
+            elif child.key == 'MaxConcurrency':
+                cloud['max_concurrency'] = int(child.values[0])
+        return cloud
+
+    @staticmethod
+    def expand_targets(clouds):
+        """ Return the (meta, settings) pair of every region of the clouds
+
+            The meta holds the name of the cloud and the region, when set.
+        """
+        targets = []
+        for cloud in clouds:
+            regions = [r.strip() for r in (cloud['regions'] or '').split(',')
+                       if r.strip()]
+            for region in regions or [None]:
+                meta = {}
+                if cloud['cloud'] is not None:
+                    meta['cloud'] = cloud['cloud']
+                if region is not None:
+                    meta['region'] = region
+                targets.append((meta, dict(cloud, region=region)))
+        return targets
+
+    def configure_targets(self, config, targets):
+        """ Create one plugin per target, sharing the statistics of this one
+
+            The targets are polled by a pool of threads shared by all the
+            plugins of the process. The targets of a cloud with
+            MaxConcurrency set share a TargetLimit bounding the number of
+            plugins polling the cloud at the same time.
+        """
+        self._targets = []
+        for meta, settings in targets:
+            plugin = self.__class__(self.collectd, self.service_name,
+                                    self.local_check)
+            plugin.target = settings
+            plugin.stats = self.stats
+            plugin.config_callback(config)
+            # Only the plugin polling the targets is called by collectd
+            plugin.unregister_stagger()
+            limit = get_target_limit(
+                settings['cloud'] or settings['keystone_url'],
+                settings['max_concurrency'])
+            self._targets.append((meta, plugin, limit))
+        self._target_pool = get_worker_pool(
+            'openstack-target', min(len(targets), self.target_workers))
+
+    def collect(self):
+        if self.out_of_process or not self._targets:
+            return super(CollectdPlugin, self).collect()
+        return self.iter_targets_metrics()
+
+    def start_target(self, plugin, limit, delay):
+        """ Return the Job polling a target
+
+            Neither the delay nor the wait for a slot of the target's limit
+            hold a thread of the pool: the job is queued by a timer when
+            its start is due and, if the cloud is at its limit, by the first
+            poll of the cloud which returns. The pool only runs the targets
+            ready to be polled.
+        """
+        def poll():
+            try:
+                return list(plugin.itermetrics())
+            finally:
+                if limit is not None:
+                    limit.release()
+
+        job = base.Job(poll, (), {})
+        if limit is None:
+            submit = lambda: self._target_pool.put(job)
+        else:
+            submit = lambda: limit.submit(self._target_pool, job)
+        if delay:
+            timer = threading.Timer(delay, submit)
+            timer.daemon = True
+            timer.start()
+        else:
+            submit()
+        return job
+
+    def iter_targets_metrics(self):
+        """ Poll all the targets concurrently and yield their metrics with
+            the cloud and the region in meta.
+
+            The start of the targets is spread over TargetStagger seconds.
+            The metrics of the targets which succeeded are yielded before
+            failing the check of the plugin if any target failed.
+        """
+        stagger = float(self.target_stagger) / len(self._targets)
+        jobs = [self.start_target(plugin, limit, i * stagger)
+                for i, (_, plugin, limit) in enumerate(self._targets)]
+        for job in jobs:
+            job.wait()
+        failed = []
+        for (target_meta, _, _), job in zip(self._targets, jobs):
+            if job.exception is not None:
+                target = '/'.join(target_meta[k] for k in ('cloud', 'region')
+                                  if k in target_meta)
+                self.logger.error('{}: Failed to get metrics from {}: '
+                                  '{}'.format(self.plugin, target,
+                                              job.exception))
+                failed.append(target)
+                continue
+            for metric in job.result:
+                if isinstance(metric, tuple):
+                    metric = self._tuple_to_dict(metric)
+                meta = dict(metric.get('meta') or {})
+                for k, v in target_meta.items():
+                    meta.setdefault(k, v)
+                yield dict(metric, meta=meta)
+
+        if failed:
+            raise base.CheckException(
+                'Failed to get metrics from {}'.format(', '.join(failed)))
+
+    def dispatch_self_metrics(self, duration):
+        super(CollectdPlugin, self).dispatch_self_metrics(duration)
+        circuit_breakers = dict(self.os_client.circuit_breakers)
+        for meta, plugin, _ in [({}, self, None)] + self._targets:
+            for service, age in sorted(plugin._snapshot_ages.items()):
+                metric = {
+                    'plugin_instance': 'collector_worker_snapshot_age',
+                    'type_instance': service,
+                    'values': age,
+                }
+                if meta:
+                    metric['meta'] = dict(meta)
+                self.dispatch_metric(metric)
+            circuit_breakers.update(plugin.os_client.circuit_breakers)
+        # 0: closed, 1: open, 2: half-open
+        for endpoint, breaker in sorted(circuit_breakers.items()):
+            self.dispatch_metric({
+                'plugin_instance': 'collector_circuit_state',
+                'type_instance': endpoint.split('://')[-1].replace(':', '_'),
+                'values': breaker.state,
+            })
 
     @property
     def service_catalog(self):
         if not self.os_client.service_catalog:
             # In case the service catalog is empty (eg Keystone was down when
             # collectd started), we should try to get a new token
-            self.os_client.get_token()
+            self.os_client.ensure_token()
         return self.os_client.service_catalog
 
     def get_service(self, service_name):
-        return next((x for x in self.service_catalog
-                    if x['name'] == service_name), None)
+        """ Return the catalog entry of a service by name or by type """
+        if not self.service_catalog:
+            return None
+        return self.os_client.service_index.get(service_name)
 
     def config_callback(self, config):
         super(CollectdPlugin, self).config_callback(config)
@@ -292,7 +1369,8 @@ class CollectdPlugin(base.Base):
         username = os.getenv('OS_USERNAME')
         user_domain = os.getenv('OS_USER_DOMAIN_NAME')
         region = os.getenv('OS_REGION_NAME')
-        
+        clouds = []
+
         for node in config.children:
             if node.key == 'Username' and username is None:
                 username = node.values[0]
@@ -305,10 +1383,73 @@ class CollectdPlugin(base.Base):
             elif node.key == 'UserDomain' and user_domain is None:
                 user_domain = node.values[0]                
             elif node.key == 'Region' and region is None:
-                region = node.values[0]
+                region = ','.join(node.values)
             elif node.key == 'PaginationLimit':
                 self.pagination_limit = int(node.values[0])
+            elif node.key == 'CacheTTL':
+                self.cache_ttl[node.values[0]] = int(node.values[1])
+            elif node.key == 'CircuitBreakerThreshold':
+                self.breaker_threshold = int(node.values[0])
+            elif node.key == 'CircuitBreakerTimeout':
+                self.breaker_timeout = int(node.values[0])
+            elif node.key == 'ChangesSince':
+                # ChangesSince "<resource>" "<query parameter>"
+                self.changes_since[node.values[0]] = node.values[1]
+            elif node.key == 'FullResyncInterval':
+                self.full_resync_interval = datetime.timedelta(
+                    0, int(node.values[0]))
+            elif node.key == 'DeltaMode':
+                self.delta_mode = node.values[0] in [True, 'True', 'true']
+            elif node.key == 'HeartbeatInterval':
+                self.heartbeat_interval = int(node.values[0])
+            elif node.key == 'Cloud':
+                clouds.append(self.parse_cloud(node))
+            elif node.key == 'PoolMaxSize':
+                # PoolMaxSize <size> or PoolMaxSize "<service>" <size>
+                if len(node.values) > 1:
+                    self.service_pool_sizes[node.values[0]] = int(
+                        node.values[1])
+                else:
+                    self.pool_maxsize = int(node.values[0])
+            elif node.key == 'PoolBlock':
+                self.pool_block = node.values[0] in [True, 'True', 'true']
+            elif node.key == 'JsonDecoder':
+                self.json_decoder = node.values[0]
+            elif node.key == 'TargetWorkers':
+                self.target_workers = int(node.values[0])
+            elif node.key == 'TargetStagger':
+                self.target_stagger = float(node.values[0])
+
+        if self.delta_mode:
+            self.state_tracker = base.StateTracker(self.heartbeat_interval)
+
+        # Every region of every cloud (the one of the OS_* variables and the
+        # <Cloud> blocks) is polled by its own plugin, see
+        # configure_targets()
+        if self.target is None:
+            default = {'cloud': None, 'keystone_url': keystone_url,
+                       'username': username, 'password': password,
+                       'tenant': tenant_name, 'domain': user_domain,
+                       'regions': region, 'max_concurrency': 0}
+            if keystone_url is not None or not clouds:
+                clouds.insert(0, default)
+            targets = self.expand_targets(clouds)
+            if len(targets) > 1 or clouds[0] is not default:
+                self.configure_targets(config, targets)
+                target = dict(default, region=None)
+            else:
+                target = targets[0][1]
+        else:
+            target = self.target
 
-        self.os_client = OSClient(username, password, tenant_name, user_domain, region,
-                                  keystone_url, self.timeout, self.logger,
-                                  self.max_retries)
\ No newline at end of file
+        self.os_client = OSClient(target['username'], target['password'],
+                                  target['tenant'], target['domain'],
+                                  target['region'], target['keystone_url'],
+                                  self.timeout, self.logger,
+                                  self.max_retries, stats=self.stats,
+                                  breaker_threshold=self.breaker_threshold,
+                                  breaker_timeout=self.breaker_timeout,
+                                  pool_maxsize=self.pool_maxsize,
+                                  pool_block=self.pool_block,
+                                  service_pool_sizes=self.service_pool_sizes,
+                                  json_decoder=self.json_decoder)
\ No newline at end of file
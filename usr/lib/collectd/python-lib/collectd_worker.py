@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Worker process of the plugins configured with OutOfProcess
+
+It is started by collectd_base.ProcessWorker and talks to it with frames
+over its standard input and output: the configuration of the plugin comes
+first, then each COLLECT frame runs a read cycle whose values are sent back
+in METRICS frames. The collectd module, which only exists inside collectd,
+is replaced by a stand-in forwarding the log messages and the
+notifications.
+"""
+
+import importlib
+import json
+import os
+import sys
+import threading
+import traceback
+import types
+
+import collectd_base as base
+
+# Number of values sent per METRICS frame
+BATCH_SIZE = 1000
+
+
+class Node(object):
+    """ A configuration node rebuilt from collectd_base.config_to_dict() """
+
+    def __init__(self, key, values, children):
+        self.key = key
+        self.values = values
+        self.children = [Node(**child) for child in children]
+
+
+class Output(object):
+    """ The frames sent to collectd, from any thread of the worker """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+
+    def send(self, kind, payload):
+        with self.lock:
+            base.write_frame(self.fd, kind, payload)
+
+    def send_json(self, kind, data):
+        self.send(kind, json.dumps(data).encode('utf-8'))
+
+
+def make_collectd_module(output):
+    module = types.ModuleType('collectd')
+
+    def make_log(level):
+        def log(message):
+            output.send_json(base.FRAME_LOG, [level, str(message)])
+        return log
+
+    for level in ('debug', 'info', 'notice', 'warning', 'error'):
+        setattr(module, level, make_log(level))
+
+    def register(*args, **kwargs):
+        pass
+
+    module.register_config = register
+    module.register_init = register
+    module.register_read = register
+    module.register_shutdown = register
+    module.NOTIF_FAILURE = 1
+    module.NOTIF_WARNING = 2
+    module.NOTIF_OKAY = 4
+
+    class Values(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+        def dispatch(self):
+            output.send(base.FRAME_METRICS, base.pack_metrics([{
+                'plugin_instance': getattr(self, 'plugin_instance', ''),
+                'type': getattr(self, 'type', 'gauge'),
+                'type_instance': getattr(self, 'type_instance', ''),
+                'hostname': getattr(self, 'host', ''),
+                'values': self.values,
+                'meta': getattr(self, 'meta', None),
+                'interval': getattr(self, 'interval', 0),
+            }]))
+
+    class Notification(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+        def dispatch(self):
+            output.send_json(base.FRAME_NOTIFICATION, [
+                self.message, self.severity, self.plugin_instance,
+                self.type_instance])
+
+    module.Values = Values
+    module.Notification = Notification
+    return module
+
+
+def run_cycle(plugin, output):
+    error = None
+    check = False
+    try:
+        batch = []
+        for metric in plugin.collect():
+            batch.append(metric)
+            if len(batch) >= BATCH_SIZE:
+                output.send(base.FRAME_METRICS, base.pack_metrics(batch))
+                batch = []
+        if batch:
+            output.send(base.FRAME_METRICS, base.pack_metrics(batch))
+    except base.CheckException as e:
+        error = str(e)
+        check = True
+    except Exception as e:
+        error = 'Failed to get metrics: {}'.format(e)
+        plugin.logger.error('{}: {}'.format(error, traceback.format_exc()))
+    output.send_json(base.FRAME_DONE, {
+        'error': error,
+        'check': check,
+        'stats': plugin.stats.snapshot(),
+    })
+
+
+def main():
+    output = Output(os.dup(1))
+    # Anything printed goes to the standard error, not to the frames
+    os.dup2(2, 1)
+    sys.modules['collectd'] = make_collectd_module(output)
+
+    plugin = None
+    while True:
+        try:
+            kind, payload = base.read_frame(0)
+        except base.CheckException:
+            # collectd is gone
+            return
+        if kind == base.FRAME_CONFIG:
+            config = json.loads(payload.decode('utf-8'))
+            plugin = importlib.import_module(config['module']).plugin
+            plugin.config_callback(Node(**config['config']))
+            plugin.out_of_process = False
+        elif kind == base.FRAME_COLLECT:
+            run_cycle(plugin, output)
+
+
+if __name__ == '__main__':
+    main()
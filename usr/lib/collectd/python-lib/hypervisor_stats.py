@@ -12,6 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import collectd
+import heapq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import collectd_openstack as openstack
 
@@ -19,6 +25,22 @@ PLUGIN_NAME = 'hypervisor_stats'
 INTERVAL = openstack.INTERVAL
 
 
+def percentiles(values, qs):
+    """ Return the qs percentiles of a sorted list of values
+
+    They are interpolated linearly between the closest ranks, like
+    numpy.percentile() does.
+    """
+    last = len(values) - 1
+    result = []
+    for q in qs:
+        pos = last * q / 100.0
+        lo = int(pos)
+        hi = min(lo + 1, last)
+        result.append(values[lo] + (values[hi] - values[lo]) * (pos - lo))
+    return result
+
+
 class HypervisorStatsPlugin(openstack.CollectdPlugin):
     """ Class to report the statistics on Nova hypervisors."""
     VALUE_MAP = {
@@ -30,96 +52,131 @@ class HypervisorStatsPlugin(openstack.CollectdPlugin):
         'free_ram_mb': 'free_ram_MB',
         'vcpus_used': 'used_vcpus',
     }
+    # Fields of the hypervisors used by the plugin, the others are dropped
+    # as soon as they are decoded
+    FIELDS = tuple(VALUE_MAP) + ('id', 'hypervisor_hostname', 'vcpus')
+    # Columns of the table of the hypervisor values, see load_table()
+    COLUMNS = tuple(VALUE_MAP) + ('vcpus',)
+    # Percentiles of the free RAM of the hosts reported per aggregate
+    PERCENTILES = (50, 95)
+    # Paging through the hypervisors requires the 2.33 microversion
+    PAGINATION_HEADERS = {'X-OpenStack-Nova-API-Version': '2.33'}
+    # The hypervisors are polled every INTERVAL seconds by default, whatever
+    # the interval of the other plugins
+    POLLING_INTERVAL_ENV = 'OS_HYPERVISOR_POLLING_INTERVAL'
 
     def __init__(self, *args, **kwargs):
         super(HypervisorStatsPlugin, self).__init__(*args, **kwargs)
         self.plugin = PLUGIN_NAME
         self.interval = INTERVAL
+        self.polling_interval = INTERVAL
+        # Nova aggregates indexed by name and by host, see update_aggregates()
+        self._aggregates_response = None
+        self._aggregates = {}
+        self._host_aggregates = {}
+        # With TopK, only the TopK highest and lowest hosts of each metric
+        # of TopKMetrics (all by default) are reported
+        self.top_k = 0
+        self.top_k_metrics = None
 
     def config_callback(self, config):
         super(HypervisorStatsPlugin, self).config_callback(config)
         for node in config.children:
             if node.key == 'CpuAllocationRatio':
                 self.extra_config['cpu_ratio'] = float(node.values[0])
+            elif node.key == 'TopK':
+                self.top_k = int(node.values[0])
+            elif node.key == 'TopKMetrics':
+                self.top_k_metrics = set(node.values)
         if 'cpu_ratio' not in self.extra_config:
             self.logger.warning('CpuAllocationRatio parameter not set')
+        # The aggregates are revalidated on every cycle unless configured
+        # otherwise; they're only re-indexed when their content changes
+        self.cache_ttl.setdefault('os-aggregates', 0)
+
+    def update_aggregates(self, aggregates_list):
+        """ Index the Nova aggregates by name and by host.
+
+            The index maps each host (without domain name) to the names of
+            the aggregates it belongs to.
+        """
+        self._aggregates = {}
+        self._host_aggregates = {}
+        for agg in aggregates_list:
+            self._aggregates[agg['name']] = agg['id']
+            for host in set(h.split('.')[0] for h in agg['hosts']):
+                self._host_aggregates.setdefault(host, []).append(agg['name'])
 
     def itermetrics(self):
-        nova_aggregates = {}
         r = self.get('nova', 'os-aggregates')
         if not r:
             self.logger.warning("Could not get nova aggregates")
-        else:
-            aggregates_list = r.json().get('aggregates', [])
-            for agg in aggregates_list:
-                nova_aggregates[agg['name']] = {
-                    'id': agg['id'],
-                    'hosts': [h.split('.')[0] for h in agg['hosts']],
-                    'metrics': {'free_vcpus': 0},
-                }
-                nova_aggregates[agg['name']]['metrics'].update(
-                    {v: 0 for v in self.VALUE_MAP.values()}
-                )
+            self._aggregates_response = None
+            self.update_aggregates([])
+        elif r is not self._aggregates_response:
+            # The index is only rebuilt when the aggregates have changed
+            self._aggregates_response = r
+            r_json = self.os_client.parse_json(r, 'nova', 'os-aggregates')
+            self.update_aggregates(r_json.get('aggregates', []))
 
-        r = self.get('nova', 'os-hypervisors/detail')
-        if not r:
+        headers = None
+        if self.pagination_limit:
+            headers = self.PAGINATION_HEADERS
+        hypervisor_stats = self.get_incremental(
+            'nova', 'os-hypervisors/detail', 'hypervisors', headers=headers,
+            paginate=True, fields=self.FIELDS)
+        if hypervisor_stats is None:
             self.logger.warning("Could not get hypervisor statistics")
             return
 
-        total_stats = {v: 0 for v in self.VALUE_MAP.values()}
-        total_stats['free_vcpus'] = 0
-        hypervisor_stats = r.json().get('hypervisors', [])
-        for stats in hypervisor_stats:
-            # remove domain name and keep only the hostname portion
-            host = stats['hypervisor_hostname'].split('.')[0]
-            for k, v in self.VALUE_MAP.iteritems():
-                m_val = stats.get(k, 0)
-                yield {
-                    'plugin_instance': v,
-                    'values': m_val,
-                    'meta': {'host': host},
-                }
-                total_stats[v] += m_val
-                for agg in nova_aggregates.keys():
-                    agg_hosts = nova_aggregates[agg]['hosts']
-                    if host in agg_hosts:
-                        nova_aggregates[agg]['metrics'][v] += m_val
-            if 'cpu_ratio' in self.extra_config:
-                m_vcpus = stats.get('vcpus', 0)
-                m_vcpus_used = stats.get('vcpus_used', 0)
-                free = (int(self.extra_config['cpu_ratio'] *
-                        m_vcpus)) - m_vcpus_used
-                yield {
-                    'plugin_instance': 'free_vcpus',
-                    'values': free,
-                    'meta': {'host': host},
-                }
-                total_stats['free_vcpus'] += free
-                for agg in nova_aggregates.keys():
-                    agg_hosts = nova_aggregates[agg]['hosts']
-                    if host in agg_hosts:
-                        free = ((int(self.extra_config['cpu_ratio'] *
-                                     m_vcpus)) -
-                                m_vcpus_used)
-                        nova_aggregates[agg]['metrics']['free_vcpus'] += free
+        for metric in self.iter_hypervisor_metrics(hypervisor_stats):
+            yield metric
+
+    def iter_hypervisor_metrics(self, hypervisor_stats):
+        """ Yield the per-host, per-aggregate and global metrics
+
+            The values of the hypervisors are loaded in a table with one
+            column per field (see load_table()) which is then reduced as a
+            whole for the totals and, through the membership of the hosts in
+            the aggregates, for the aggregates (see reduce_aggregates()).
+        """
+        hosts, columns = self.load_table(hypervisor_stats)
+        fields = [(v, k) for k, v in self.VALUE_MAP.iteritems()]
+        fields.append(('free_vcpus', 'free_vcpus'))
+
+        if self.extra_config.get('cpu_ratio') is not None:
+            host_fields = [(v, columns[k]) for v, k in fields]
+        else:
+            host_fields = [(v, columns[k]) for v, k in fields[:-1]]
+        if self.top_k:
+            for metric in self.iter_top_hosts(hosts, host_fields):
+                yield metric
+        else:
+            for i, host in enumerate(hosts):
+                meta = {'host': host}
+                for v, column in host_fields:
+                    yield (v, column[i], meta)
 
         # Dispatch the aggregate metrics
-        for agg in nova_aggregates.keys():
-            agg_id = nova_aggregates[agg]['id']
+        names, sums, free_ram = self.reduce_aggregates(hosts, columns, fields)
+        for i, agg in enumerate(names):
+            agg_id = self._aggregates[agg]
+            metrics = dict((v, sums[v][i]) for v, _ in fields)
             agg_total_free_ram = (
-                nova_aggregates[agg]['metrics']['free_ram_MB'] +
-                nova_aggregates[agg]['metrics']['used_ram_MB']
+                metrics['free_ram_MB'] + metrics['used_ram_MB']
             )
             # Only emit metric when value is > 0
             # If this is not the case, (for instance when no host
             # in aggregate), this requires the corresponding alarms to
             # have a 'skip' no_data_policy, so as not to be triggered
             if agg_total_free_ram > 0:
-                nova_aggregates[agg]['metrics']['free_ram_percent'] = round(
-                    (100.0 * nova_aggregates[agg]['metrics']['free_ram_MB']) /
-                    agg_total_free_ram,
+                metrics['free_ram_percent'] = round(
+                    (100.0 * metrics['free_ram_MB']) / agg_total_free_ram,
                     2)
-            for k, v in nova_aggregates[agg]['metrics'].iteritems():
+            if free_ram[i] is not None:
+                for q, value in zip(self.PERCENTILES, free_ram[i]):
+                    metrics['free_ram_MB_p{}'.format(q)] = value
+            for k, v in metrics.iteritems():
                 yield {
                     'plugin_instance': 'aggregate_{}'.format(k),
                     'values': v,
@@ -129,20 +186,143 @@ class HypervisorStatsPlugin(openstack.CollectdPlugin):
                     }
                 }
         # Dispatch the global metrics
-        for k, v in total_stats.iteritems():
+        for v, k in fields:
             yield {
-                'plugin_instance': 'total_{}'.format(k),
-                'values': v,
+                'plugin_instance': 'total_{}'.format(v),
+                'values': sum(columns[k]),
             }
 
+    def iter_top_hosts(self, hosts, host_fields):
+        """ Yield the values of the TopK highest and lowest hosts of each
+            metric of TopKMetrics
+
+            The hosts are selected with heaps bounded to TopK entries so
+            that the number of values doesn't grow with the fleet.
+        """
+        indices = range(len(hosts))
+        for v, column in host_fields:
+            if self.top_k_metrics is not None and v not in self.top_k_metrics:
+                continue
+            selected = set(heapq.nlargest(self.top_k, indices,
+                                          key=column.__getitem__))
+            selected.update(heapq.nsmallest(self.top_k, indices,
+                                            key=column.__getitem__))
+            for i in sorted(selected):
+                yield (v, column[i], {'host': hosts[i]})
+
+    def load_table(self, hypervisor_stats):
+        """ Return the hosts and a table of their values
+
+            The table holds one column (a list indexed like the hosts) per
+            field of COLUMNS plus the free_vcpus computed from the
+            CpuAllocationRatio (0 without ratio).
+        """
+        hosts = []
+        columns = dict((k, []) for k in self.COLUMNS)
+        appenders = [(k, columns[k].append) for k in self.COLUMNS]
+        for stats in hypervisor_stats:
+            # remove domain name and keep only the hostname portion
+            hosts.append(stats['hypervisor_hostname'].split('.')[0])
+            for k, append in appenders:
+                append(stats.get(k, 0))
+
+        cpu_ratio = self.extra_config.get('cpu_ratio')
+        if cpu_ratio is not None:
+            columns['free_vcpus'] = [
+                int(cpu_ratio * vcpus) - vcpus_used
+                for vcpus, vcpus_used in zip(columns['vcpus'],
+                                             columns['vcpus_used'])]
+        else:
+            columns['free_vcpus'] = [0] * len(hosts)
+        return hosts, columns
+
+    def reduce_aggregates(self, hosts, columns, fields):
+        """ Sum the columns by aggregate and rank the free RAM of each one
+
+            fields is a list of (metric, column) pairs. Returns the names of
+            the aggregates, the sums indexed by metric then by aggregate and
+            the PERCENTILES of the free RAM of the hosts of each aggregate
+            (None for an aggregate without host). numpy is used when
+            available.
+        """
+        names = list(self._aggregates)
+        index = dict((name, i) for i, name in enumerate(names))
+        # Membership of the hosts in the aggregates as (aggregate, host)
+        # index pairs
+        agg_idx = []
+        host_idx = []
+        for i, host in enumerate(hosts):
+            for agg in self._host_aggregates.get(host, ()):
+                agg_idx.append(index[agg])
+                host_idx.append(i)
+
+        if numpy is not None:
+            sums, free_ram = self._reduce_numpy(len(names), agg_idx,
+                                                host_idx, columns, fields)
+        else:
+            sums, free_ram = self._reduce_python(len(names), agg_idx,
+                                                 host_idx, columns, fields)
+        return names, sums, free_ram
+
+    def _reduce_python(self, count, agg_idx, host_idx, columns, fields):
+        members = list(zip(agg_idx, host_idx))
+        sums = {}
+        for v, k in fields:
+            column = columns[k]
+            total = [0] * count
+            for a, h in members:
+                total[a] += column[h]
+            sums[v] = total
+
+        free_ram = [[] for _ in range(count)]
+        column = columns['free_ram_mb']
+        for a, h in members:
+            free_ram[a].append(column[h])
+        return sums, [percentiles(sorted(values), self.PERCENTILES)
+                      if values else None for values in free_ram]
+
+    def _reduce_numpy(self, count, agg_idx, host_idx, columns, fields):
+        agg_idx = numpy.array(agg_idx, dtype=numpy.intp)
+        host_idx = numpy.array(host_idx, dtype=numpy.intp)
+        sums = {}
+        for v, k in fields:
+            column = numpy.array(columns[k])[host_idx]
+            total = numpy.bincount(agg_idx, weights=column, minlength=count)
+            if column.dtype.kind in 'iu':
+                # The weighted counts are floats, exact below 2 ** 53
+                total = numpy.rint(total).astype(numpy.int64)
+            sums[v] = total.tolist()
+
+        # Sort the free RAM by aggregate then by value to interpolate the
+        # percentiles of all the aggregates at once
+        free_ram = numpy.array(columns['free_ram_mb'],
+                               dtype=numpy.float64)[host_idx]
+        free_ram = free_ram[numpy.lexsort((free_ram, agg_idx))]
+        sizes = numpy.bincount(agg_idx, minlength=count)
+        if not len(free_ram):
+            return sums, [None] * count
+        starts = numpy.cumsum(sizes) - sizes
+        last = numpy.maximum(starts + sizes - 1, 0)
+        result = []
+        for q in self.PERCENTILES:
+            pos = starts + numpy.maximum(sizes - 1, 0) * (q / 100.0)
+            lo = numpy.minimum(numpy.floor(pos).astype(numpy.intp), last)
+            hi = numpy.minimum(lo + 1, last)
+            result.append(free_ram[lo] +
+                          (free_ram[hi] - free_ram[lo]) * (pos - lo))
+        result = numpy.array(result).T.tolist()
+        return sums, [values if size else None
+                      for size, values in zip(sizes, result)]
+
+
 plugin = HypervisorStatsPlugin(collectd, PLUGIN_NAME)
 
 
 def config_callback(conf):
     plugin.config_callback(conf)
+    collectd.register_read(read_callback, plugin.polling_interval)
 
 def read_callback():
     plugin.read_callback()
 
 collectd.register_config(config_callback)
-collectd.register_read(read_callback, INTERVAL)
@@ -42,17 +42,17 @@ class CinderServiceStatsPlugin(openstack.CollectdPlugin):
         # State can be: 'up', 'down' or 'disabled'
         aggregated_workers = defaultdict(Counter)
 
+        self.start_worker_states()
         for worker in self.iter_workers('cinder'):
             host = worker['host'].split('.')[0]
             service = self.cinder_re.sub('', worker['service'])
             state = worker['state']
 
             aggregated_workers[service][state] += 1
-            yield {
-                'plugin_instance': 'cinder_service',
-                'values': self.states[state],
-                'meta': {'host': host, 'service': service, 'state': state},
-            }
+            for metric in self.iter_worker_state('cinder_service', host, service,
+                                                 state, self.states[state]):
+                yield metric
+        self.end_worker_states()
 
         for service in aggregated_workers:
             totalw = sum(aggregated_workers[service].values())
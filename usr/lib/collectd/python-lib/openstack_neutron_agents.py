@@ -43,6 +43,7 @@ class NeutronAgentStatsPlugin(openstack.CollectdPlugin):
         # State can be up or down
         aggregated_agents = defaultdict(Counter)
 
+        self.start_worker_states()
         for agent in self.iter_workers('neutron'):
             host = agent['host'].split('.')[0]
             service = self.agent_re.sub(
@@ -51,11 +52,10 @@ class NeutronAgentStatsPlugin(openstack.CollectdPlugin):
 
             aggregated_agents[service][state] += 1
 
-            yield {
-                'plugin_instance': service,
-                'values': self.states[state],
-                'meta': {'host': host, 'service': service, 'state': state}
-            }
+            for metric in self.iter_worker_state(service, host, service,
+                                                 state, self.states[state]):
+                yield metric
+        self.end_worker_states()
 
 plugin = NeutronAgentStatsPlugin(collectd, PLUGIN_NAME)
 